@@ -0,0 +1,171 @@
+import asyncio
+import json
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from .workflow import Workflow
+
+class BatchingScheduler:
+    """Merges generation requests from concurrent sessions into batches for one shared LanguageModel.
+
+    Requests wait at most max_wait seconds for others to join them and a batch holds at most
+    max_batch_size chats. While a batch runs on the model thread new requests queue up and form
+    the next one. Requests are only merged when their generation arguments are identical.
+    """
+
+    def __init__(self, lm, max_batch_size=8, max_wait=0.05):
+        self.lm = lm
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = None
+        self.task = None
+        self.loop = None
+        # A single thread owns the model, batches run one after another
+        self.model_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model")
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.requests = asyncio.Queue()
+        self.task = asyncio.create_task(self.schedule())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.model_thread.shutdown(wait=True)
+
+    async def submit(self, chat_histories, generation_args):
+        future = self.loop.create_future()
+        await self.requests.put((chat_histories, generation_args, future))
+        return await future
+
+    async def call(self, function, *args):
+        # Generations that cannot be batched still have to run on the thread owning the model
+        return await self.loop.run_in_executor(self.model_thread, function, *args)
+
+    async def schedule(self):
+        while True:
+            batch = [await self.requests.get()]
+            size = len(batch[0][0])
+            deadline = self.loop.time() + self.max_wait
+            while size < self.max_batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self.requests.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                batch.append(request)
+                size += len(request[0])
+
+            groups = {}
+            for request in batch:
+                key = json.dumps(request[1], sort_keys=True, default=str)
+                groups.setdefault(key, []).append(request)
+            for requests in groups.values():
+                await self.run_batch(requests)
+
+    async def run_batch(self, requests):
+        chats = [chat for chat_histories, _, _ in requests for chat in chat_histories]
+        try:
+            responses = await self.loop.run_in_executor(self.model_thread, self.lm.generate_batch, chats, requests[0][1])
+        except Exception as error:
+            for _, _, future in requests:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        offset = 0
+        for chat_histories, _, future in requests:
+            if not future.done():
+                future.set_result(responses[offset:offset + len(chat_histories)])
+            offset += len(chat_histories)
+
+
+class ScheduledLanguageModel:
+    """Drop-in LanguageModel for nodes running in session threads, generation goes through the scheduler."""
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def generate_text(self, chat_history, generation_args):
+        return self.generate_batch([chat_history], generation_args)[0]
+
+    def generate_batch(self, chat_histories, generation_args):
+        future = asyncio.run_coroutine_threadsafe(self.scheduler.submit(chat_histories, generation_args), self.scheduler.loop)
+        return future.result()
+
+    def call(self, function, *args):
+        future = asyncio.run_coroutine_threadsafe(self.scheduler.call(function, *args), self.scheduler.loop)
+        return future.result()
+
+    def __getattr__(self, name):
+        # Tokenizer helpers and the like come straight from the shared model
+        attribute = getattr(self.scheduler.lm, name)
+        if name == "generate_structured":
+            # Only models with constrained decoding have it, its generations run on the model thread
+            return lambda chat_history, fields, generation_args: self.call(attribute, chat_history, fields, generation_args)
+        return attribute
+
+
+class AsyncWorkflow(Workflow):
+    """Workflow whose nodes run in a thread pool so that many sessions share one event loop."""
+
+    def __init__(self, lm, documentation, executor=None, dataset_cache=None, session_threads=None, num_candidates=1, tracer=None):
+        self.user_inputs = queue.Queue()
+        super().__init__(lm, documentation, executor, dataset_cache, input_fn=self.next_user_input, num_candidates=num_candidates, tracer=tracer)
+        self.session_threads = session_threads
+
+    def next_user_input(self, prompt=""):
+        # Called from the session thread, blocks until send_input delivers a message
+        return self.user_inputs.get()
+
+    def send_input(self, text):
+        self.user_inputs.put(text)
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        while not self.is_done():
+            print(f'[{self.context.session_id[:8]}] Inside Workflow, current state is:', self.state)
+            await loop.run_in_executor(self.session_threads, self.next_trigger())
+            self.transitions.append((self.state, self.current_node.name, self.state))
+
+
+class WorkflowEngine:
+    """Serves many concurrent workflow sessions against a single loaded LanguageModel.
+
+    Without an ExecutionPool, generated code runs in the agent process one session at a time.
+    """
+
+    def __init__(self, lm, executor=None, dataset_cache=None, max_sessions=64, max_batch_size=8, max_wait=0.05, tracer=None):
+        self.scheduler = BatchingScheduler(lm, max_batch_size, max_wait)
+        self.lm = ScheduledLanguageModel(self.scheduler)
+        self.executor = executor
+        self.dataset_cache = dataset_cache
+        self.tracer = tracer  # Optional Tracer shared by all sessions
+        # Session nodes block on generation and execution, so every active session gets a thread
+        self.session_threads = ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix="session")
+
+    async def start(self):
+        await self.scheduler.start()
+
+    async def stop(self):
+        await self.scheduler.stop()
+        self.session_threads.shutdown(wait=False)
+
+    def create_session(self, documentation, num_candidates=1):
+        return AsyncWorkflow(self.lm, documentation, self.executor, self.dataset_cache, self.session_threads, num_candidates, self.tracer)
+
+    async def run_sessions(self, sessions):
+        return await asyncio.gather(*(session.run_async() for session in sessions), return_exceptions=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, exc_traceback):
+        await self.stop()
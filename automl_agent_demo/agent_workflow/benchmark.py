@@ -0,0 +1,265 @@
+import difflib
+import gc
+import json
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from .instrumentation import RssSampler, Tracer, current_rss_mb
+from .workflow import Workflow
+
+# Code the stand-in model "generates": reads the dataset and aggregates it, like a light training script
+SYNTHETIC_CODE = (
+    "import pandas as pd\n"
+    "data = pd.{reader}(\"{dataset_url}\")\n"
+    "summary = data.groupby(\"{target_column}\").mean(numeric_only=True)\n"
+    "print(summary)\n"
+)
+# Runtime error on the first attempt, to exercise validation and the fix loop
+FAILING_LINE = "print(data[\"{target_column}_score\"].mean())\n"
+
+
+class FakeLanguageModel:
+    """Deterministic stand-in for LanguageModel, no model weights, GPU or network needed.
+
+    Responses come from (substring, response) rules matched against the last user message, the
+    first matching rule wins. Latency is simulated as prefill_latency plus latency_per_token for
+    every generated token; a response counts len(response) // 4 tokens unless tokens_per_response
+    is given. Generations are recorded as "lm" spans when a tracer is set, like LanguageModel.
+    """
+
+    def __init__(self, rules: list, prefill_latency: float = 0.0, latency_per_token: float = 0.0, tokens_per_response: int = None, tracer=None):
+        self.rules = rules
+        self.prefill_latency = prefill_latency
+        self.latency_per_token = latency_per_token
+        self.tokens_per_response = tokens_per_response
+        self.tracer = tracer
+        self.calls = 0
+
+    @staticmethod
+    def load_rules(path: str) -> list:
+        # Recorded responses, one {"match": ..., "response": ...} object per line
+        with open(path) as rules_file:
+            return [(rule["match"], rule["response"]) for rule in map(json.loads, rules_file) if rule]
+
+    def respond(self, chat_history: list) -> str:
+        prompt = chat_history[-1]["content"]
+        for match, response in self.rules:
+            if match in prompt:
+                return response
+        return "False"
+
+    def count_tokens(self, text: str) -> int:
+        return len(text) // 4
+
+    def generate_text(self, chat_history: list, generation_args: dict) -> str:
+        return self.generate_batch([chat_history], generation_args)[0]
+
+    def generate_batch(self, chat_histories: list, generation_args: dict) -> list:
+        self.calls += 1
+        responses = [self.respond(chat_history) for chat_history in chat_histories]
+        generated_tokens = max(self.tokens_per_response or self.count_tokens(response) for response in responses)
+        prompt_tokens = sum(self.count_tokens(message["content"] or "") for chat_history in chat_histories for message in chat_history)
+        if self.tracer is None:
+            time.sleep(self.prefill_latency + generated_tokens * self.latency_per_token)
+            return responses
+        with self.tracer.span("lm", "generate", batch_size=len(chat_histories), prompt_tokens=prompt_tokens) as span:
+            time.sleep(self.prefill_latency + generated_tokens * self.latency_per_token)
+            span.attributes.update({
+                "generated_tokens": generated_tokens * len(chat_histories),
+                "prefill_seconds": self.prefill_latency,
+                "decode_seconds": generated_tokens * self.latency_per_token,
+            })
+        return responses
+
+
+class BenchmarkScenario:
+    def __init__(self, name: str, rows: int, file_format: str = "csv", fail_first: bool = False, target_column: str = "label"):
+        self.name = name
+        self.rows = rows
+        self.file_format = file_format
+        self.fail_first = fail_first  # The first generated code fails at runtime and goes through a fix
+        self.target_column = target_column
+
+    def dataset_path(self, data_dir) -> Path:
+        return Path(data_dir) / f"benchmark_{self.rows}.{self.file_format}"
+
+    def code(self, dataset_url: str) -> str:
+        reader = "read_csv" if self.file_format == "csv" else "read_parquet"
+        return SYNTHETIC_CODE.format(reader=reader, dataset_url=dataset_url, target_column=self.target_column)
+
+    def rules(self, dataset_url: str) -> list:
+        code = self.code(dataset_url)
+        generated_code = code + FAILING_LINE.format(target_column=self.target_column) if self.fail_first else code
+        # Prompt fragments of NodeConfig and Conversation, fixes are checked before generation
+        return [
+            ("Fix this error", code),
+            ("write code to FIND AND EVALUATE", generated_code),
+            ("url for a csv or parquet", dataset_url),
+            ("machine learning task", "classification"),
+            ("target column", self.target_column),
+        ]
+
+
+def generate_dataset(path, rows: int, num_features: int = 8, num_classes: int = 3, target_column: str = "label", seed: int = 0):
+    """Write a synthetic classification dataset, existing files of the same size are reused."""
+    path = Path(path)
+    if path.exists():
+        return path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    generator = np.random.default_rng(seed)
+    data = pd.DataFrame(generator.normal(size=(rows, num_features)), columns=[f"feature_{index}" for index in range(num_features)])
+    data["category"] = generator.choice(["a", "b", "c", "d"], size=rows)
+    data[target_column] = generator.integers(0, num_classes, size=rows)
+    staging_path = path.with_suffix(path.suffix + ".tmp")
+    if path.suffix == ".csv":
+        data.to_csv(staging_path, index=False)
+    else:
+        data.to_parquet(staging_path, index=False)
+    staging_path.replace(path)
+    return path
+
+
+def run_scenario(scenario: BenchmarkScenario, data_dir, executor=None, dataset_cache=None, lm_options: dict = None, extra_rules: list = None) -> dict:
+    """Run the whole workflow non-interactively on one scenario and report its timings and memory."""
+    dataset_url = str(generate_dataset(scenario.dataset_path(data_dir), scenario.rows, target_column=scenario.target_column).resolve())
+    tracer = Tracer()
+    lm = FakeLanguageModel((extra_rules or []) + scenario.rules(dataset_url), tracer=tracer, **(lm_options or {}))
+    user_inputs = iter([f"Find the best classification model for the dataset at {dataset_url} with target column {scenario.target_column}"])
+    workflow = Workflow(lm, "", executor, dataset_cache, input_fn=lambda prompt="": next(user_inputs, ""), tracer=tracer)
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        workflow.run()
+        total_seconds = time.perf_counter() - started
+
+    spans = tracer.find(session_id=workflow.context.session_id)
+    stages, breakdown = {}, {}
+    for span in spans:
+        totals = stages if span.kind == "node" else breakdown
+        key = span.name if span.kind == "node" else f"{span.kind}:{span.name}"
+        totals[key] = totals.get(key, 0.0) + span.duration
+    return {
+        "scenario": scenario.name,
+        "rows": scenario.rows,
+        "format": scenario.file_format,
+        "state": workflow.state,
+        "total_seconds": total_seconds,
+        "stages": stages,
+        "breakdown": breakdown,
+        "lm_calls": lm.calls,
+        "dataset_mb": Path(dataset_url).stat().st_size / 1024 ** 2,
+        # Of the agent process while the scenario ran, execution workers of an ExecutionPool are not
+        # included; the increase does not depend on what earlier scenarios left behind
+        "peak_rss_mb": rss.peak_mb,
+        "rss_increase_mb": rss.increase_mb,
+    }
+
+
+def compare_to_baseline(results: list, baseline: dict, tolerance: float = 0.2, min_seconds: float = 0.05, min_mb: float = 20.0) -> list:
+    """Return a message for every metric more than tolerance above its baseline value.
+
+    Differences under min_seconds (or min_mb for memory) are noise and are not reported.
+    """
+    regressions = []
+    for result in results:
+        reference = baseline.get(result["scenario"])
+        if reference is None:
+            continue
+        if result["state"] != reference["state"]:
+            regressions.append(f"{result['scenario']}: ended in {result['state']} instead of {reference['state']}")
+        metrics = [("total_seconds", result["total_seconds"], reference["total_seconds"], min_seconds)]
+        metrics += [
+            (f"stages.{stage}", seconds, reference["stages"][stage], min_seconds)
+            for stage, seconds in result["stages"].items() if stage in reference["stages"]
+        ]
+        if "rss_increase_mb" in reference:
+            metrics.append(("rss_increase_mb", result["rss_increase_mb"], reference["rss_increase_mb"], min_mb))
+        for metric, value, reference_value, minimum in metrics:
+            if value > reference_value * (1 + tolerance) and value - reference_value > minimum:
+                regressions.append(f"{result['scenario']}: {metric} {value:.3f} vs baseline {reference_value:.3f}")
+    return regressions
+
+
+def load_baseline(path) -> dict:
+    path = Path(path)
+    if not path.exists():
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(path, results: list):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as baseline_file:
+        json.dump({result["scenario"]: result for result in results}, baseline_file, indent=2)
+
+
+def format_report(results: list) -> str:
+    lines = []
+    for result in results:
+        lines.append(
+            f"{result['scenario']}: {result['state']} in {result['total_seconds']:.2f}s, "
+            f"{result['lm_calls']} model calls, dataset {result['dataset_mb']:.1f}MB, peak RSS {result['peak_rss_mb']:.0f}MB (+{result['rss_increase_mb']:.0f}MB)"
+        )
+        for name, seconds in sorted({**result["stages"], **result["breakdown"]}.items(), key=lambda item: -item[1]):
+            lines.append(f"    {name:<32} {seconds:8.3f}s")
+    return "\n".join(lines)
+
+
+def compare_backends(load_model, configs: dict, prompts: list, generation_args: dict) -> list:
+    """Run the same prompts on several model configurations, one after the other.
+
+    configs maps a name to keyword arguments of load_model (e.g. LanguageModel backend and
+    quantization); the first configuration is the reference the outputs of the others are
+    compared with. Reports load time, latency, decode speed, memory and output similarity.
+    """
+    reference, results = None, []
+    for name, options in configs.items():
+        tracer = Tracer()
+        rss_before = current_rss_mb()
+        started = time.perf_counter()
+        lm = load_model(tracer=tracer, **options)
+        load_seconds = time.perf_counter() - started
+        rss_loaded = current_rss_mb()
+
+        outputs, latencies = [], []
+        for prompt in prompts:
+            started = time.perf_counter()
+            outputs.append(lm.generate_text(prompt, generation_args))
+            latencies.append(time.perf_counter() - started)
+        spans = tracer.find("lm")
+        generated_tokens = sum(span.attributes.get("generated_tokens", 0) for span in spans)
+        decode_seconds = sum(span.attributes.get("decode_seconds", 0.0) for span in spans)
+
+        if reference is None:
+            reference = outputs
+        similarities = [difflib.SequenceMatcher(None, output, expected).ratio() for output, expected in zip(outputs, reference)]
+        results.append({
+            "backend": name,
+            "load_seconds": load_seconds,
+            "model_mb": rss_loaded - rss_before,
+            "mean_latency_seconds": sum(latencies) / len(latencies),
+            "max_latency_seconds": max(latencies),
+            "prefill_seconds": sum(span.attributes.get("prefill_seconds", 0.0) for span in spans),
+            "tokens_per_second": generated_tokens / decode_seconds if decode_seconds > 0 else None,
+            "exact_match": sum(output == expected for output, expected in zip(outputs, reference)) / len(outputs),
+            "similarity": sum(similarities) / len(similarities),
+            "outputs": outputs,
+        })
+        # Release the model before loading the next one
+        del lm
+        gc.collect()
+    return results
+
+
+def format_backend_report(results: list) -> str:
+    lines = [f"{'backend':<16} {'load s':>8} {'model MB':>9} {'latency s':>10} {'tok/s':>8} {'exact':>6} {'similar':>8}"]
+    for result in results:
+        tokens_per_second = f"{result['tokens_per_second']:.1f}" if result["tokens_per_second"] else "-"
+        lines.append(
+            f"{result['backend']:<16} {result['load_seconds']:8.1f} {result['model_mb']:9.0f} {result['mean_latency_seconds']:10.2f} "
+            f"{tokens_per_second:>8} {result['exact_match']:6.2f} {result['similarity']:8.2f}"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,111 @@
+import fcntl
+import json
+import os
+import time
+from pathlib import Path
+
+# Bumped when the layout changes, older checkpoints are then ignored
+CHECKPOINT_VERSION = 2
+# WorkflowContext fields produced by the nodes, everything else is rebuilt when resuming
+CONTEXT_FIELDS = ("session_id", "inputs", "code", "candidates", "fixed_code", "execution_success", "errors", "pending_fix")
+# A run that reached one of these states has nothing left to resume
+FINAL_STATES = ("finished", "max_retries_reached")
+
+
+class WorkflowCheckpoint:
+    """JSON snapshot of a workflow's state and context, rewritten atomically after every transition.
+
+    metadata holds whatever the caller needs to rebuild the workflow when resuming, e.g. the
+    documentation URL; it has to be JSON serializable. Concurrent runs keep their checkpoints
+    apart by naming them after their session (for_session), and the run using a checkpoint holds
+    an advisory lock on a sidecar file (acquire) so that no other process resumes it meanwhile.
+    """
+
+    def __init__(self, path: str, metadata: dict = None):
+        self.path = Path(path)
+        self.metadata = metadata or {}
+        self.lock_path = self.path.with_suffix(".lock")
+        self.lock_file = None  # Open while this process holds the lock
+
+    @classmethod
+    def for_session(cls, directory, session_id: str, metadata: dict = None):
+        return cls(Path(directory) / f"{session_id}.json", metadata)
+
+    @classmethod
+    def latest(cls, directory):
+        # Checkpoint of the most recently interrupted run in directory, locked for this process.
+        # Checkpoints of runs still going are locked by them and skipped, None when none is left
+        modified = []
+        for path in Path(directory).glob("*.json"):
+            try:
+                modified.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                pass  # Cleared by a run finishing meanwhile
+        for _, path in sorted(modified, reverse=True):
+            checkpoint = cls(path)
+            if checkpoint.acquire():
+                return checkpoint
+        return None
+
+    def acquire(self) -> bool:
+        """Lock the checkpoint until release() or the end of the process, False when another process holds it."""
+        if self.lock_file is not None:
+            return True
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.lock_path, "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        self.lock_file = lock_file
+        return True
+
+    def release(self):
+        if self.lock_file is not None:
+            # Closing the file releases the lock
+            self.lock_file.close()
+            self.lock_file = None
+
+    def save(self, workflow):
+        context = workflow.context
+        data = {
+            "version": CHECKPOINT_VERSION,
+            "saved_at": time.time(),
+            "state": workflow.state,
+            "metadata": self.metadata,
+            "context": {field: getattr(context, field) for field in CONTEXT_FIELDS},
+            "nodes": {key: node.get_state() for key, node in workflow.nodes.items()},
+        }
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        staging_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        with open(staging_path, "w") as checkpoint_file:
+            json.dump(data, checkpoint_file, separators=(",", ":"))
+        os.replace(staging_path, self.path)
+
+    def load(self):
+        """Return the saved checkpoint, None when there is none or it cannot be used."""
+        if not self.path.exists():
+            return None
+        try:
+            with open(self.path) as checkpoint_file:
+                data = json.load(checkpoint_file)
+        except (OSError, json.JSONDecodeError) as error:
+            print(f"Ignoring unreadable checkpoint {self.path}: {error}")
+            return None
+        if data.get("version") != CHECKPOINT_VERSION:
+            print(f"Ignoring checkpoint {self.path} of another version")
+            return None
+        if data.get("state") in FINAL_STATES:
+            self.clear()
+            return None
+        # Metadata of the interrupted run, unless the caller set its own
+        self.metadata = self.metadata or data.get("metadata", {})
+        return data
+
+    def clear(self):
+        if self.path.exists():
+            self.path.unlink()
+        # The lock file goes too, it is still held until release()
+        if self.lock_file is not None and self.lock_path.exists():
+            self.lock_path.unlink()
@@ -0,0 +1,193 @@
+import ast
+import difflib
+import fcntl
+import json
+import os
+import re
+import tempfile
+import threading
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+# "@@ 12-13" replaces lines 12 to 13 with the lines that follow, "@@ 12-11" inserts before line 12
+HUNK_HEADER = re.compile(r"^@@\s*(\d+)\s*-\s*(\d+)\s*@*\s*$")
+
+
+class PatchError(ValueError):
+    pass
+
+
+def parse_patch(text: str) -> list:
+    """Parse a line-range patch into (start, end, new_lines) hunks with 1-based inclusive ranges."""
+    hunks = []
+    for line in text.strip("\n").split("\n"):
+        if line.strip().startswith("```"):
+            continue
+        header = HUNK_HEADER.match(line.strip())
+        if header:
+            hunks.append((int(header.group(1)), int(header.group(2)), []))
+        elif hunks:
+            hunks[-1][2].append(line)
+    if not hunks:
+        raise PatchError("The response does not contain any '@@ start-end' hunk")
+    return hunks
+
+
+def apply_patch(code: str, hunks: list) -> str:
+    lines = code.split("\n")
+    # Bottom-up, so line numbers of the remaining hunks stay valid
+    for start, end, new_lines in sorted(hunks, key=lambda hunk: hunk[0], reverse=True):
+        if start < 1 or end < start - 1 or end > len(lines):
+            raise PatchError(f"Hunk @@ {start}-{end} is outside of the {len(lines)} line code")
+        lines[start - 1:end] = new_lines
+    return "\n".join(lines)
+
+
+def to_replacements(old_code: str, new_code: str) -> list:
+    """Describe the change between two codes as content-anchored (old_lines, new_lines) pairs."""
+    old_lines, new_lines = old_code.split("\n"), new_code.split("\n")
+    replacements = []
+    for tag, old_start, old_end, new_start, new_end in difflib.SequenceMatcher(a=old_lines, b=new_lines, autojunk=False).get_opcodes():
+        if tag == "equal":
+            continue
+        if old_start == old_end:
+            # Pure insertions are anchored on the line before them
+            if old_start == 0:
+                continue
+            old_start -= 1
+            new_start -= 1
+        replacements.append((old_lines[old_start:old_end], new_lines[new_start:new_end]))
+    return replacements
+
+
+def apply_replacements(code: str, replacements: list):
+    """Apply replacements by locating their old lines in code, returns None when one cannot be found."""
+    lines = code.split("\n")
+    for old_lines, new_lines in replacements:
+        if not old_lines:
+            return None
+        stripped_old = [line.strip() for line in old_lines]
+        position = next(
+            (index for index in range(len(lines) - len(old_lines) + 1)
+             if [line.strip() for line in lines[index:index + len(old_lines)]] == stripped_old),
+            None,
+        )
+        if position is None:
+            return None
+        # Re-indent the replacement to where the old lines sit in this code
+        shift = indentation(lines[position]) - indentation(old_lines[0])
+        lines[position:position + len(old_lines)] = [reindent(line, shift) for line in new_lines]
+    return "\n".join(lines)
+
+
+def indentation(line: str) -> int:
+    return len(line) - len(line.lstrip(" "))
+
+
+def reindent(line: str, shift: int) -> str:
+    if shift > 0:
+        return " " * shift + line
+    if shift < 0:
+        return line[min(-shift, indentation(line)):]
+    return line
+
+
+def normalize(text: str) -> str:
+    # Literals vary between sessions, the shape of the message and call does not
+    text = re.sub(r"'[^']*'|\"[^\"]*\"", "<str>", text)
+    text = re.sub(r"\b\d+(\.\d+)?\b", "<num>", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def error_signature(errors: list, code: str) -> str:
+    """Normalized exception type, message template and failing call of a traceback."""
+    traceback_text = "".join(errors or [])
+    lines = [line for line in traceback_text.strip().split("\n") if line.strip()]
+    exception = lines[-1] if lines else ""
+    failing_call = ""
+    # Runtime tracebacks point at "<string>" frames, the static checks report "(line N)"
+    frames = re.findall(r'File "<string>", line (\d+)', traceback_text) or re.findall(r"\(line (\d+)\)", traceback_text)
+    code_lines = code.split("\n")
+    if frames and 0 < int(frames[-1]) <= len(code_lines):
+        failing_call = code_lines[int(frames[-1]) - 1]
+    return f"{normalize(exception)} | {normalize(failing_call)}"
+
+
+def failing_statement(errors: list, code: str):
+    """Index of the top-level statement a runtime traceback failed in, None for static check errors."""
+    # The outermost "<string>" frame is the module-level statement, later frames are inside calls
+    frames = re.findall(r'File "<string>", line (\d+)', "".join(errors or []))
+    if not frames:
+        return None
+    try:
+        statements = ast.parse(code).body
+    except SyntaxError:
+        return None
+    line = int(frames[0])
+    for index, statement in enumerate(statements):
+        if statement.lineno <= line <= statement.end_lineno:
+            return index
+    return None
+
+
+class FixMemo:
+    """Maps error signatures to the replacements that fixed them before, persisted as JSON.
+
+    Several processes may share the file: a success is recorded under a lock file, on top of
+    what the file holds at that moment.
+    """
+
+    def __init__(self, path: str = None, max_fixes_per_signature: int = 5):
+        self.path = Path(path) if path else None
+        self.max_fixes_per_signature = max_fixes_per_signature
+        self.lock = threading.Lock()
+        self.fixes = self.load()  # signature -> [{"replacements": [...], "successes": int}]
+
+    def load(self) -> dict:
+        if self.path is None or not self.path.exists():
+            return {}
+        try:
+            with open(self.path) as memo_file:
+                return json.load(memo_file)
+        except (OSError, json.JSONDecodeError) as error:
+            print(f"Ignoring unreadable fix memo {self.path}: {error}")
+            return {}
+
+    @contextmanager
+    def file_lock(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path.with_name(self.path.name + ".lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def candidates(self, signature: str) -> list:
+        with self.lock:
+            fixes = sorted(self.fixes.get(signature, []), key=lambda fix: -fix["successes"])
+            return [fix["replacements"] for fix in fixes]
+
+    def record_success(self, signature: str, replacements: list):
+        if not replacements:
+            return
+        replacements = [[list(old_lines), list(new_lines)] for old_lines, new_lines in replacements]
+        with self.lock, self.file_lock() if self.path is not None else nullcontext():
+            # Fixes other runs recorded since this memo was loaded are kept
+            if self.path is not None:
+                self.fixes = self.load()
+            fixes = self.fixes.setdefault(signature, [])
+            for fix in fixes:
+                if fix["replacements"] == replacements:
+                    fix["successes"] += 1
+                    break
+            else:
+                fixes.append({"replacements": replacements, "successes": 1})
+            fixes.sort(key=lambda fix: -fix["successes"])
+            del fixes[self.max_fixes_per_signature:]
+            self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=self.path.parent, prefix=self.path.name, suffix=".tmp", delete=False) as memo_file:
+            json.dump(self.fixes, memo_file)
+        os.replace(memo_file.name, self.path)
@@ -0,0 +1,244 @@
+import ast
+import builtins
+import importlib
+import importlib.util
+import inspect
+import traceback
+from contextlib import contextmanager, nullcontext
+
+# Names bound by the interpreter in every module namespace
+MODULE_NAMES = {"__name__", "__file__", "__doc__", "__builtins__", "__spec__", "__loader__", "__package__"}
+# Calls a dry run stops after: pycaret's setup, or the dataset reads when the code has no setup call
+SETUP_FUNCTIONS = {"setup"}
+READ_FUNCTIONS = {"read_csv", "read_parquet", "read_excel", "read_json", "get_data", "load_dataset"}
+
+
+def static_check(code: str) -> list:
+    """Compile the code and check that its imports exist and every name it reads is bound somewhere.
+
+    The check does not import anything, so it is cheap enough to run in the agent process.
+    Returns a list of error messages, empty when the code looks runnable.
+    """
+    try:
+        tree = ast.parse(code)
+        compile(tree, "<string>", "exec")
+    except SyntaxError as error:
+        return ["".join(traceback.format_exception_only(type(error), error))]
+
+    errors = []
+    has_star_import = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            modules = [node.module]
+            has_star_import = has_star_import or any(alias.name == "*" for alias in node.names)
+        else:
+            continue
+        for module in modules:
+            top_level = module.split(".")[0]
+            if importlib.util.find_spec(top_level) is None:
+                errors.append(f"ModuleNotFoundError: No module named '{top_level}' (line {node.lineno})")
+
+    # Names from a star import are unknown without importing the module, the dry run covers them
+    if not has_star_import:
+        bound = bound_names(tree) | set(dir(builtins)) | MODULE_NAMES
+        reported = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Load) and node.id not in bound and node.id not in reported:
+                reported.add(node.id)
+                errors.append(f"NameError: name '{node.id}' is not defined (line {node.lineno})")
+    return errors
+
+
+def bound_names(tree) -> set:
+    # Every name bound anywhere in the module, scopes are ignored to avoid false positives
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.arg):
+            names.add(node.arg)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                names.add(alias.asname or alias.name.split(".")[0])
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names.add(node.name)
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names.update(node.names)
+        elif isinstance(node, ast.MatchAs) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchStar) and node.name:
+            names.add(node.name)
+        elif isinstance(node, ast.MatchMapping) and node.rest:
+            names.add(node.rest)
+    return names
+
+
+def check_call_signatures(code: str):
+    """Bind every call to an imported library function against its signature without running it.
+
+    Imports the libraries the code uses, so it is meant to run inside an execution worker that
+    already has them loaded. Returns (success, errors) like ExecuteCodeNode.execute_code.
+    """
+    tree = ast.parse(code)
+    imported = {}
+    for node in tree.body:
+        if isinstance(node, ast.ImportFrom) and node.level == 0:
+            module = import_or_none(node.module)
+            if module is None:
+                continue
+            for alias in node.names:
+                if alias.name == "*":
+                    public = getattr(module, "__all__", [name for name in dir(module) if not name.startswith("_")])
+                    imported.update({name: getattr(module, name, None) for name in public})
+                else:
+                    imported[alias.asname or alias.name] = getattr(module, alias.name, None)
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                if alias.asname:
+                    imported[alias.asname] = import_or_none(alias.name)
+
+    # Names rebound by the code itself no longer refer to the imported objects
+    rebound = assigned_names(tree)
+    imported = {name: value for name, value in imported.items() if value is not None and name not in rebound}
+
+    errors = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        if any(isinstance(arg, ast.Starred) for arg in node.args) or any(keyword.arg is None for keyword in node.keywords):
+            continue
+        function, name = resolve_call_target(node.func, imported)
+        if function is None or not callable(function):
+            continue
+        try:
+            signature = inspect.signature(function)
+        except (TypeError, ValueError):
+            continue
+        try:
+            signature.bind(*node.args, **{keyword.arg: keyword.value for keyword in node.keywords})
+        except TypeError as error:
+            errors.append(f"TypeError: {name}() {error} (line {node.lineno})")
+    return not errors, errors or None
+
+
+def assigned_names(tree) -> set:
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, (ast.Store, ast.Del)):
+            names.add(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.add(node.name)
+    return names
+
+
+def resolve_call_target(func, imported):
+    if isinstance(func, ast.Name):
+        return imported.get(func.id), func.id
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and inspect.ismodule(imported.get(func.value.id)):
+        return getattr(imported[func.value.id], func.attr, None), f"{func.value.id}.{func.attr}"
+    return None, None
+
+
+def import_or_none(module_name):
+    try:
+        return importlib.import_module(module_name)
+    except Exception:
+        return None
+
+
+def stratified_sample(data, target_column=None, fraction=0.01, min_rows=200, min_class_rows=10, random_state=0):
+    """Sample rows keeping the class balance of target_column (quantile bins for continuous targets).
+
+    Every class keeps at least min_class_rows rows (all of them when it has fewer), pycaret's
+    stratified splits and its default of 10 folds fail on classes with fewer members.
+    """
+    sample_size = max(min_rows, int(len(data) * fraction))
+    if len(data) <= sample_size:
+        return data
+    if target_column is None or target_column not in data.columns:
+        return data.sample(n=sample_size, random_state=random_state)
+
+    import numpy as np
+    import pandas as pd
+
+    strata = data[target_column]
+    if pd.api.types.is_numeric_dtype(strata) and strata.nunique() > 20:
+        strata = pd.qcut(strata.rank(method="first"), q=10, labels=False)
+    fraction = sample_size / len(data)
+    generator = np.random.default_rng(random_state)
+    sampled_positions = []
+    for positions in data.groupby(strata, dropna=False, sort=False).indices.values():
+        # Rare classes keep enough rows to be split, so they still reach the model
+        sample_count = max(min(len(positions), min_class_rows), round(len(positions) * fraction))
+        sampled_positions.append(generator.choice(positions, size=sample_count, replace=False))
+    return data.iloc[np.sort(np.concatenate(sampled_positions))]
+
+
+@contextmanager
+def sampled_reads(target_column=None, fraction=0.01, min_rows=200):
+    """Make pandas CSV/Parquet readers return a stratified row sample while the context is active."""
+    import pandas as pd
+
+    original_readers = {"read_csv": pd.read_csv, "read_parquet": pd.read_parquet}
+
+    def sampling_reader(reader):
+        def read(*args, **kwargs):
+            data = reader(*args, **kwargs)
+            if isinstance(data, pd.DataFrame):
+                return stratified_sample(data, target_column, fraction, min_rows)
+            return data
+        return read
+
+    for name, reader in original_readers.items():
+        setattr(pd, name, sampling_reader(reader))
+    try:
+        yield
+    finally:
+        for name, reader in original_readers.items():
+            setattr(pd, name, reader)
+
+
+def dry_run_statements(code: str) -> list:
+    """Top-level statements of the code up to its last setup call, or its last dataset read without one.
+
+    Model training, saving and whatever else follows only runs in the real execution. Code that
+    neither reads a dataset nor calls setup only runs its leading imports.
+    """
+    statements = ast.parse(code).body
+    for functions in (SETUP_FUNCTIONS, READ_FUNCTIONS):
+        calling = [index for index, statement in enumerate(statements) if functions & called_names(statement)]
+        if calling:
+            return statements[:calling[-1] + 1]
+    imports = 0
+    while imports < len(statements) and isinstance(statements[imports], (ast.Import, ast.ImportFrom)):
+        imports += 1
+    return statements[:imports]
+
+
+def called_names(node) -> set:
+    names = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Call):
+            if isinstance(child.func, ast.Name):
+                names.add(child.func.id)
+            elif isinstance(child.func, ast.Attribute):
+                names.add(child.func.attr)
+    return names
+
+
+def dry_run(code: str, target_column=None, fraction=0.01, min_rows=200, dataset_cache=None):
+    """Execute the code up to its setup on a stratified sample of every dataset it reads, returning (success, errors)."""
+    # The sample is drawn from the cached copy when a DatasetCache is given
+    cached_reads = dataset_cache.redirect_reads() if dataset_cache is not None else nullcontext()
+    with cached_reads, sampled_reads(target_column, fraction, min_rows):
+        try:
+            # Statements keep their line numbers, tracebacks point at the full code
+            module = ast.Module(body=dry_run_statements(code), type_ignores=[])
+            exec(compile(module, "<string>", "exec"), {"__name__": "__main__"})
+        except Exception:
+            return False, [traceback.format_exc()]
+    return True, None
@@ -0,0 +1,217 @@
+import re
+import torch
+from transformers import LogitsProcessor
+
+# Characters a free-form JSON string value may not contain in this grammar
+FORBIDDEN_STRING_CHARACTERS = set('"\\\n\r\t')
+
+
+class JsonFieldsGrammar:
+    """Character-level state machine for a flat JSON object with fixed keys and string-or-null values.
+
+    fields is a list of (key, options) pairs. options is None for a free string, a list of allowed
+    strings, or a callable receiving the values decoded so far and returning either of those, so an
+    enum can depend on an earlier field (e.g. the columns of the dataset at the extracted URL).
+    """
+
+    def __init__(self, fields: list):
+        self.keys = [key for key, _ in fields]
+        self.options = [options for _, options in fields]
+        self.segments = []
+        for index, key in enumerate(self.keys):
+            self.segments.append(("{" if index == 0 else ", ") + f'"{key}": ')
+            self.segments.append(index)
+        self.segments.append("}")
+        self.resolved_options = {}
+
+    def initial_state(self):
+        # (segment index, characters consumed in a literal segment, value buffer, decoded values)
+        return (0, 0, "", ())
+
+    def is_complete(self, state) -> bool:
+        return state[0] == len(self.segments)
+
+    def field_options(self, index, values):
+        options = self.options[index]
+        if callable(options):
+            key = (index, values)
+            if key not in self.resolved_options:
+                self.resolved_options[key] = options(values)
+            options = self.resolved_options[key]
+        return options
+
+    def advance(self, state, character):
+        """Return the state after character, or None when the character is not allowed."""
+        segment_index, offset, buffer, values = state
+        if segment_index == len(self.segments):
+            return None
+        segment = self.segments[segment_index]
+
+        if isinstance(segment, str):
+            if segment_index == 0 and offset == 0 and character in " \n":
+                return state
+            if segment[offset] != character:
+                return None
+            if offset + 1 == len(segment):
+                return (segment_index + 1, 0, "", values)
+            return (segment_index, offset + 1, "", values)
+
+        if buffer == "":
+            return (segment_index, 0, character, values) if character in ('"', "n") else None
+
+        if buffer[0] == "n":
+            expected = "null"
+            if expected[len(buffer)] != character:
+                return None
+            if len(buffer) + 1 == len(expected):
+                return (segment_index + 1, 0, "", values + (None,))
+            return (segment_index, 0, buffer + character, values)
+
+        content = buffer[1:]
+        options = self.field_options(segment, values)
+        if character == '"':
+            if options is not None and content not in options:
+                return None
+            return (segment_index + 1, 0, "", values + (content,))
+        if character in FORBIDDEN_STRING_CHARACTERS:
+            return None
+        if options is not None and not any(option.startswith(content + character) for option in options):
+            return None
+        return (segment_index, 0, buffer + character, values)
+
+    def advance_text(self, state, text):
+        for character in text:
+            state = self.advance(state, character)
+            if state is None:
+                return None
+        return state
+
+    def signature(self):
+        # Grammars with the same signature share their masks, dynamic options count by position only
+        return tuple(
+            (key, "dynamic" if callable(options) else options if options is None else tuple(options))
+            for key, options in zip(self.keys, self.options)
+        )
+
+    def min_value_length(self, index):
+        options = self.options[index]
+        if options is None or callable(options):
+            return 2  # ""
+        return min([len("null")] + [len(option) + 2 for option in options])
+
+    def shared_key(self, state, max_token_length):
+        """Key of the state's mask that holds for every grammar with the same signature.
+
+        The decoded values only change a mask through dynamic options within reach of one token;
+        those are part of the key when they can be resolved already, otherwise None is returned
+        and the mask is not shared.
+        """
+        segment_index, offset, buffer, values = state
+        resolved, distance = [], 0
+        for index in range(segment_index, len(self.segments)):
+            if distance >= max_token_length:
+                break
+            segment = self.segments[index]
+            if isinstance(segment, str):
+                distance += len(segment) - (offset if index == segment_index else 0)
+                continue
+            if callable(self.options[segment]):
+                if segment != len(values):
+                    return None
+                options = self.field_options(segment, values)
+                resolved.append(None if options is None else tuple(options))
+            distance += 1 if index == segment_index and buffer else self.min_value_length(segment)
+        return (self.signature(), self.state_key(state)[:-1], tuple(resolved))
+
+    def state_key(self, state):
+        # Inside a free string only the values decoded so far matter, not the characters typed
+        segment_index, offset, buffer, values = state
+        segment = self.segments[segment_index] if segment_index < len(self.segments) else None
+        if isinstance(segment, int) and buffer.startswith('"') and self.field_options(segment, values) is None:
+            return (segment_index, "free string", values)
+        return state
+
+
+def vocabulary_texts(tokenizer) -> list:
+    """Text of every token id as it appears in decoded output, None for tokens never allowed."""
+    special_ids = set(tokenizer.all_special_ids)
+    tokens = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    sentencepiece = any(token and token.startswith("▁") for token in tokens)
+    texts = []
+    for token_id, token in enumerate(tokens):
+        if token is None or token_id in special_ids:
+            texts.append(None)
+            continue
+        byte = re.fullmatch(r"<0x([0-9A-Fa-f]{2})>", token)
+        if byte:
+            value = int(byte.group(1), 16)
+            texts.append(chr(value) if 32 <= value < 127 else None)
+        elif sentencepiece:
+            texts.append(token.replace("▁", " "))
+        else:
+            text = tokenizer.convert_tokens_to_string([token])
+            texts.append(None if "�" in text else text)
+    return texts
+
+
+class JsonFieldsLogitsProcessor(LogitsProcessor):
+    """Masks every token that would take the generation outside of a JsonFieldsGrammar.
+
+    Once the object is closed only end-of-sequence tokens are allowed, so generation stops there.
+    Masks are cached per grammar state; the grammar's literal parts become forced tokens. Building
+    a mask scans the whole vocabulary, so masks that do not depend on the decoded values also go
+    to shared_masks, a dict the model keeps across generations (at most max_shared_masks of them).
+    """
+
+    def __init__(self, grammar, token_texts, prompt_length, eos_token_ids, shared_masks=None, max_shared_masks=2048):
+        self.grammar = grammar
+        self.token_texts = token_texts
+        self.prompt_length = prompt_length
+        self.eos_token_ids = list(eos_token_ids)
+        self.masks = {}
+        self.shared_masks = shared_masks
+        self.max_shared_masks = max_shared_masks
+        self.max_token_length = max(len(text) for text in token_texts if text)
+        self.row_states = {}  # row -> (tokens consumed, grammar state)
+
+    def allowed_tokens(self, state):
+        if self.grammar.is_complete(state):
+            return self.eos_token_ids
+        return [
+            token_id for token_id, text in enumerate(self.token_texts)
+            if text and self.grammar.advance_text(state, text) is not None
+        ]
+
+    def mask(self, state, vocabulary_size, device):
+        key = self.grammar.state_key(state)
+        if key in self.masks:
+            return self.masks[key]
+        shared_key = None
+        if self.shared_masks is not None:
+            shared_key = self.grammar.shared_key(state, self.max_token_length)
+        if shared_key is not None and shared_key in self.shared_masks:
+            mask = self.shared_masks[shared_key]
+        else:
+            mask = torch.full((vocabulary_size,), float("-inf"), device=device)
+            allowed = [token_id for token_id in self.allowed_tokens(state) if token_id < vocabulary_size]
+            mask[allowed] = 0
+            if shared_key is not None:
+                if len(self.shared_masks) >= self.max_shared_masks:
+                    # Oldest first, masks of datasets seen long ago are the least likely to return
+                    self.shared_masks.pop(next(iter(self.shared_masks)))
+                self.shared_masks[shared_key] = mask
+        self.masks[key] = mask
+        return mask
+
+    def __call__(self, input_ids, scores):
+        for row in range(input_ids.shape[0]):
+            generated = input_ids[row, self.prompt_length:].tolist()
+            consumed, state = self.row_states.get(row, (0, self.grammar.initial_state()))
+            for token_id in generated[consumed:]:
+                text = self.token_texts[token_id] if token_id < len(self.token_texts) else None
+                if state is not None and text is not None:
+                    state = self.grammar.advance_text(state, text)
+            self.row_states[row] = (len(generated), state)
+            if state is not None:
+                scores[row] = scores[row] + self.mask(state, scores.shape[-1], scores.device)
+        return scores
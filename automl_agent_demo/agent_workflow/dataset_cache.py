@@ -0,0 +1,209 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+import requests
+
+# Bytes read from the start of a remote CSV looking for the end of its header
+MAX_HEADER_BYTES = 1024 ** 2
+
+class DatasetCache:
+    """Local columnar copies of the datasets a workflow works on.
+
+    A dataset is fetched and parsed once, then stored as an uncompressed Feather file keyed by its
+    location and ETag/Last-Modified (remote) or mtime/size (local); the validators of a remote location
+    are requested once per cache. Schema queries are answered from the Feather metadata, the header of
+    a CSV or the footer of a Parquet file without reading rows, and pandas reads of a cached location made by the
+    generated code are served from the memory-mapped copy.
+    """
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = Path(cache_dir or Path.home() / ".cache" / "automl_agent" / "datasets")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.fingerprints = {}  # remote location -> fingerprint
+
+    def __getstate__(self):
+        # Only the directory and fingerprints travel to execution workers, locks cannot be pickled
+        return {"cache_dir": self.cache_dir, "fingerprints": self.fingerprints}
+
+    def __setstate__(self, state):
+        self.cache_dir = state["cache_dir"]
+        self.fingerprints = dict(state["fingerprints"])
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def is_remote(location: str) -> bool:
+        return location.startswith(("http://", "https://"))
+
+    def fingerprint(self, location: str) -> str:
+        if self.is_remote(location):
+            if location in self.fingerprints:
+                return self.fingerprints[location]
+            version = ""
+            try:
+                response = requests.head(location, allow_redirects=True, timeout=10)
+                response.raise_for_status()
+                version = response.headers.get("ETag") or response.headers.get("Last-Modified") or ""
+                version += "|" + response.headers.get("Content-Length", "")
+            except requests.exceptions.RequestException:
+                # Without validators the location alone identifies the cached copy
+                pass
+            return self.fingerprints.setdefault(location, f"{location}|{version}")
+        stat = os.stat(location)
+        return f"{os.path.abspath(location)}|{stat.st_mtime_ns}|{stat.st_size}"
+
+    def cache_path(self, location: str) -> Path:
+        digest = hashlib.sha256(self.fingerprint(location).encode("utf-8")).hexdigest()[:32]
+        return self.cache_dir / f"{digest}.feather"
+
+    def materialize(self, location: str) -> Path:
+        """Fetch and convert the dataset once, returning the path of its Feather copy."""
+        path = self.cache_path(location)
+        if path.exists():
+            return path
+
+        import pyarrow.feather as feather
+
+        with self.lock:
+            if path.exists():
+                return path
+            with tempfile.TemporaryDirectory(dir=self.cache_dir) as staging_dir:
+                source = location
+                if self.is_remote(location):
+                    source = os.path.join(staging_dir, Path(location.split("?")[0]).name)
+                    with requests.get(location, stream=True, timeout=60) as response:
+                        response.raise_for_status()
+                        response.raw.decode_content = True
+                        with open(source, "wb") as downloaded:
+                            shutil.copyfileobj(response.raw, downloaded)
+                table = self.read_table(source)
+                staging_path = os.path.join(staging_dir, path.name)
+                # Uncompressed so that the copy can be memory-mapped
+                feather.write_feather(table, staging_path, compression="uncompressed")
+                os.replace(staging_path, path)
+        return path
+
+    @staticmethod
+    def read_table(source: str):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if source.lower().endswith(".parquet"):
+            return pq.read_table(source)
+        import pandas as pd
+
+        # CSV is parsed by pandas so dtypes match what the generated code would have read itself
+        return pa.Table.from_pandas(pd.read_csv(source), preserve_index=False)
+
+    def columns(self, location: str) -> list:
+        """Column names of the dataset, read from metadata only."""
+        import pyarrow as pa
+
+        path = self.cache_path(location)
+        if not path.exists():
+            # Files not converted yet answer schema queries directly, without a conversion
+            names = self.remote_columns(location) if self.is_remote(location) else self.local_columns(location)
+            if names is not None:
+                return names
+
+        path = self.materialize(location)
+        with pa.memory_map(str(path)) as source:
+            return pa.ipc.open_file(source).schema.names
+
+    @staticmethod
+    def local_columns(location: str) -> list:
+        if location.lower().endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            return pq.read_schema(location).names
+        import pandas as pd
+
+        return list(pd.read_csv(location, nrows=0).columns)
+
+    def remote_columns(self, location: str) -> list:
+        """Column names from the first line of a remote CSV or the footer of a remote Parquet file, None when unavailable."""
+        import pandas as pd
+
+        try:
+            if location.split("?")[0].lower().endswith(".parquet"):
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                # The file ends with the footer length and the magic bytes
+                tail = self.fetch_range(location, "bytes=-8")
+                footer = tail and self.fetch_range(location, f"bytes=-{int.from_bytes(tail[:4], 'little') + 8}")
+                if not footer:
+                    return None
+                # The magic bytes followed by the footer parse as a file without row groups
+                return pq.read_schema(pa.BufferReader(b"PAR1" + footer)).names
+
+            head = b""
+            with requests.get(location, stream=True, timeout=60) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(64 * 1024):
+                    head += chunk
+                    if b"\n" in head or len(head) > MAX_HEADER_BYTES:
+                        break
+            if b"\n" not in head and len(head) > MAX_HEADER_BYTES:
+                return None
+            return list(pd.read_csv(io.BytesIO(head.split(b"\n")[0]), nrows=0).columns)
+        except (requests.exceptions.RequestException, ValueError):
+            # Parser and Arrow errors are ValueErrors, the full conversion decides then
+            return None
+
+    @staticmethod
+    def fetch_range(location: str, byte_range: str) -> bytes:
+        with requests.get(location, headers={"Range": byte_range}, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            # A server ignoring the range would send the whole file
+            return response.content if response.status_code == 206 else None
+
+    def load(self, location: str, columns=None):
+        import pyarrow.feather as feather
+
+        path = self.materialize(location)
+        return feather.read_table(str(path), columns=columns, memory_map=True).to_pandas()
+
+    @contextmanager
+    def redirect_reads(self):
+        """Serve pandas CSV/Parquet reads of dataset locations from the cache while the context is active."""
+        import pandas as pd
+        import pyarrow as pa
+
+        original_read_csv, original_read_parquet = pd.read_csv, pd.read_parquet
+
+        def load_or_none(location, columns):
+            try:
+                return self.load(location, columns)
+            except pa.ArrowException:
+                # Data that does not round-trip through Arrow is read the usual way
+                return None
+
+        def read_csv(filepath_or_buffer, *args, **kwargs):
+            # Only plain reads (optionally selecting columns) can be answered from the cached table
+            if isinstance(filepath_or_buffer, str) and filepath_or_buffer.lower().endswith(".csv") and not args and set(kwargs) <= {"usecols"}:
+                usecols = kwargs.get("usecols")
+                if usecols is None or all(isinstance(column, str) for column in usecols):
+                    data = load_or_none(filepath_or_buffer, list(usecols) if usecols is not None else None)
+                    if data is not None:
+                        return data
+            return original_read_csv(filepath_or_buffer, *args, **kwargs)
+
+        def read_parquet(path, *args, **kwargs):
+            if isinstance(path, str) and path.lower().endswith(".parquet") and not args and set(kwargs) <= {"columns", "engine"}:
+                data = load_or_none(path, kwargs.get("columns"))
+                if data is not None:
+                    return data
+            return original_read_parquet(path, *args, **kwargs)
+
+        pd.read_csv, pd.read_parquet = read_csv, read_parquet
+        try:
+            yield
+        finally:
+            pd.read_csv, pd.read_parquet = original_read_csv, original_read_parquet
@@ -0,0 +1,100 @@
+import math
+import re
+from collections import Counter
+from .utils import DataExtractor
+
+class DocChunk:
+    def __init__(self, index: int, title: str, text: str):
+        self.index = index  # Position in the page, used to keep selected chunks in reading order
+        self.title = title
+        self.text = text
+
+    def render(self) -> str:
+        return f"Section: {self.title}\n{self.text}" if self.title else self.text
+
+
+class DocumentationIndex:
+    """BM25 index over structure-aware chunks of library documentation.
+
+    Chunks follow the headings of the page; only the chunks most relevant to the user's task are
+    put into the code generation prompt, within a token budget.
+    """
+
+    def __init__(self, chunks: list, k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies = [Counter(self.tokenize(chunk.render())) for chunk in chunks]
+        self.lengths = [sum(frequencies.values()) for frequencies in self.term_frequencies]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0
+        document_frequencies = Counter(term for frequencies in self.term_frequencies for term in frequencies)
+        self.idf = {
+            term: math.log(1 + (len(chunks) - frequency + 0.5) / (frequency + 0.5))
+            for term, frequency in document_frequencies.items()
+        }
+
+    @classmethod
+    def from_html(cls, content: str, max_chunk_chars: int = 1500):
+        return cls(cls.chunk_blocks(DataExtractor.extract_blocks(content), max_chunk_chars))
+
+    @staticmethod
+    def chunk_blocks(blocks: list, max_chunk_chars: int = 1500) -> list:
+        # Group the blocks under their heading, splitting sections larger than max_chunk_chars
+        chunks = []
+        title, texts = "", []
+
+        def flush():
+            if texts:
+                chunks.append(DocChunk(len(chunks), title, "\n".join(texts)))
+                texts.clear()
+
+        for element_type, text in blocks:
+            if element_type == 'heading':
+                flush()
+                title = text
+                continue
+            if texts and sum(len(existing) for existing in texts) + len(text) > max_chunk_chars:
+                flush()
+            texts.append(text)
+        flush()
+        return chunks
+
+    @staticmethod
+    def tokenize(text: str) -> list:
+        # Identifiers like compare_models are kept whole and also split into their parts
+        terms = []
+        for word in re.findall(r"[a-z0-9_]+", text.lower()):
+            terms.append(word)
+            if "_" in word:
+                terms.extend(part for part in word.split("_") if part)
+        return terms
+
+    def search(self, query: str, top_k: int = None) -> list:
+        """Return (score, chunk) pairs ordered by decreasing BM25 score."""
+        query_terms = [term for term in set(self.tokenize(query)) if term in self.idf]
+        scored = []
+        for chunk, frequencies, length in zip(self.chunks, self.term_frequencies, self.lengths):
+            score = 0.0
+            for term in query_terms:
+                frequency = frequencies.get(term, 0)
+                if frequency:
+                    normalization = self.k1 * (1 - self.b + self.b * length / self.average_length)
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + normalization)
+            scored.append((score, chunk))
+        scored.sort(key=lambda pair: (-pair[0], pair[1].index))
+        return scored[:top_k] if top_k else scored
+
+    def build_context(self, query: str, token_budget: int, token_counter=None, top_k: int = 8) -> str:
+        """Concatenate the most relevant chunks that fit in token_budget, in the order of the page."""
+        token_counter = token_counter or (lambda text: len(text) // 4)
+        selected, used = [], 0
+        for score, chunk in self.search(query, top_k):
+            if score <= 0 and selected:
+                break
+            tokens = token_counter(chunk.render())
+            if used + tokens > token_budget:
+                continue
+            selected.append(chunk)
+            used += tokens
+        selected.sort(key=lambda chunk: chunk.index)
+        return "\n\n".join(chunk.render() for chunk in selected)
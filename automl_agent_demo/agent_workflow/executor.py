@@ -0,0 +1,307 @@
+import atexit
+import importlib
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from .statement_runner import StatementRunner
+
+# Modules imported once by the fork server, so every worker starts with them already loaded
+DEFAULT_PRELOAD_MODULES = ("pandas", "sklearn", "pycaret.classification", "pycaret.regression", "pycaret.clustering")
+# Number of sessions whose statement checkpoints a worker keeps around
+MAX_SESSIONS_PER_WORKER = 2
+# Share of a worker's memory limit its statement checkpoints may use, split between its sessions
+SNAPSHOT_MEMORY_SHARE = 0.25
+
+
+class _PipeWriter:
+    """File-like object forwarding everything written to it over the worker pipe."""
+
+    def __init__(self, connection, stream):
+        self.connection = connection
+        self.stream = stream
+
+    def write(self, text):
+        if text:
+            self.connection.send((self.stream, text))
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _worker_main(connection, preload_modules, snapshot_bytes=None):
+    # Own process group, so the joblib/loky children pycaret starts can be killed with the worker
+    os.setsid()
+    for module in preload_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            pass
+
+    sys.stdout = _PipeWriter(connection, "stdout")
+    sys.stderr = _PipeWriter(connection, "stderr")
+    connection.send(("ready", os.getpid()))
+
+    runners = OrderedDict()  # session -> StatementRunner holding that session's checkpoints
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        if "function" in request:
+            try:
+                connection.send(("result", request["function"](*request["args"])))
+            except BaseException:
+                connection.send(("result", (False, [traceback.format_exc()])))
+            continue
+
+        dataset_cache = request.get("dataset_cache")
+        cached_reads = dataset_cache.redirect_reads() if dataset_cache is not None else nullcontext()
+        session = request.get("session")
+        if session is None:
+            try:
+                with cached_reads:
+                    exec(compile(request["code"], "<string>", "exec"), {"__name__": "__main__"})
+                connection.send(("result", (True, None)))
+            except BaseException:
+                connection.send(("result", (False, [traceback.format_exc()])))
+            continue
+
+        runner = runners.pop(session, None)
+        if runner is None:
+            runner = StatementRunner(max_snapshot_bytes=snapshot_bytes) if snapshot_bytes else StatementRunner()
+        runners[session] = runner
+        while len(runners) > MAX_SESSIONS_PER_WORKER:
+            runners.popitem(last=False)
+        with cached_reads:
+            result = runner.run(request["code"])
+        connection.send(("result", result))
+
+
+class _Worker:
+    def __init__(self, context, preload_modules, snapshot_bytes=None):
+        self.connection, worker_connection = context.Pipe()
+        # Not daemonic: joblib refuses to start parallel workers from a daemonic process and pycaret
+        # would train on a single core. ExecutionPool.close stops the workers instead
+        self.process = context.Process(target=_worker_main, args=(worker_connection, preload_modules, snapshot_bytes), daemon=False)
+        self.process.start()
+        worker_connection.close()
+        self.ready = False
+
+    def wait_ready(self):
+        if not self.ready:
+            self.connection.recv()
+            self.ready = True
+
+    def process_tree(self):
+        # The worker and every process below it, e.g. joblib workers of pycaret
+        pids, pending = [], [self.process.pid]
+        while pending:
+            pid = pending.pop()
+            pids.append(pid)
+            try:
+                for task in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{task}/children") as children:
+                        pending.extend(int(child) for child in children.read().split())
+            except OSError:
+                continue
+        return pids
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self.process_tree():
+            try:
+                with open(f"/proc/{pid}/statm") as statm:
+                    total += int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, ValueError):
+                continue
+        return total
+
+    def kill_group(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def stop(self, kill=False):
+        if kill:
+            self.kill_group()
+        else:
+            try:
+                self.connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill_group()
+            self.process.join()
+        # Children left behind by a worker that exited on its own
+        self.kill_group()
+        self.connection.close()
+
+
+class ExecutionPool:
+    """Pool of warm worker interpreters that run generated code outside the agent process.
+
+    Workers are forked from a fork server that has already imported pandas/pycaret, each run is
+    bounded by a wall-clock timeout and a resident memory limit, and the output of the generated
+    code is streamed back while it runs. Limits cover the worker's child processes too (e.g. joblib
+    workers of pycaret); a worker that breaks one is killed and replaced together with its children.
+    """
+
+    def __init__(self, size=2, preload_modules=DEFAULT_PRELOAD_MODULES, timeout=None, memory_limit_mb=None, poll_interval=0.1):
+        self.preload_modules = tuple(preload_modules)
+        self.timeout = timeout
+        self.memory_limit_bytes = memory_limit_mb * 1024 ** 2 if memory_limit_mb else None
+        self.poll_interval = poll_interval
+
+        self.context = multiprocessing.get_context("forkserver")
+        self.context.set_forkserver_preload(list(self.preload_modules))
+        self.idle_workers = []
+        self.session_workers = {}  # session -> worker holding its statement checkpoints
+        self.workers = set()  # Idle and busy workers, all of them are stopped by close
+        self.closed = False
+        self.condition = threading.Condition()
+        for _ in range(size):
+            self.idle_workers.append(self.spawn_worker())
+        # Workers are not daemonic, the interpreter would wait for them at exit
+        atexit.register(self.close)
+
+    def spawn_worker(self):
+        snapshot_bytes = None
+        if self.memory_limit_bytes is not None:
+            snapshot_bytes = int(self.memory_limit_bytes * SNAPSHOT_MEMORY_SHARE / MAX_SESSIONS_PER_WORKER)
+        worker = _Worker(self.context, self.preload_modules, snapshot_bytes)
+        self.workers.add(worker)
+        return worker
+
+    def run(self, code, timeout=None, stream=True, session=None, dataset_cache=None):
+        """Execute code in a worker and return (success, errors) like ExecuteCodeNode.execute_code.
+
+        Runs tagged with a session are routed back to the worker that served the session before,
+        so that they can resume from its statement checkpoints. Pandas reads are served from
+        dataset_cache when one is given.
+        """
+        return self.submit({"code": code, "session": session, "dataset_cache": dataset_cache}, timeout, stream, session)
+
+    def run_function(self, function, *args, timeout=None, stream=True):
+        """Call an importable module-level function returning (success, errors) inside a worker."""
+        return self.submit({"function": function, "args": args}, timeout, stream)
+
+    def run_first_success(self, codes, timeout=None, sessions=None, dataset_cache=None):
+        """Run several candidate codes concurrently and stop as soon as one of them succeeds.
+
+        Returns (index of the winning code or None, list of (success, errors) per code); the
+        candidates that were cancelled or never started report None.
+        """
+        sessions = sessions or [None] * len(codes)
+        results = [None] * len(codes)
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=len(codes)) as threads:
+            futures = {
+                threads.submit(self.submit, {"code": code, "session": session, "dataset_cache": dataset_cache}, timeout, False, session, cancelled): index
+                for index, (code, session) in enumerate(zip(codes, sessions))
+            }
+            for future in as_completed(futures):
+                index = futures[future]
+                if cancelled.is_set():
+                    continue
+                results[index] = future.result()
+                if results[index][0]:
+                    # The losers are killed mid-run, their workers get replaced
+                    cancelled.set()
+                    return index, results
+        return None, results
+
+    def submit(self, request, timeout=None, stream=True, session=None, cancelled=None):
+        timeout = self.timeout if timeout is None else timeout
+        worker = self.acquire_worker(session)
+        if cancelled is not None and cancelled.is_set():
+            self.release_worker(worker, None)
+            return False, ["CancelledError: another candidate finished first"]
+        try:
+            worker.wait_ready()
+            worker.connection.send(request)
+            result, healthy = self.wait_for_result(worker, timeout, stream, cancelled)
+        except (EOFError, BrokenPipeError, OSError):
+            worker.process.join(timeout=1)
+            result = (False, [f"WorkerError: execution worker exited unexpectedly with code {worker.process.exitcode}"])
+            healthy = False
+        if not healthy:
+            worker = self.replace_worker(worker)
+        self.release_worker(worker, session if healthy else None)
+        return result
+
+    def acquire_worker(self, session):
+        with self.condition:
+            while not self.idle_workers:
+                self.condition.wait()
+            preferred = self.session_workers.get(session)
+            worker = preferred if preferred in self.idle_workers else self.idle_workers[-1]
+            self.idle_workers.remove(worker)
+            return worker
+
+    def release_worker(self, worker, session):
+        with self.condition:
+            if session is not None:
+                self.session_workers[session] = worker
+            self.idle_workers.append(worker)
+            self.condition.notify()
+
+    def wait_for_result(self, worker, timeout, stream, cancelled=None):
+        """Wait for the worker's result, returning ((success, errors), whether the worker can be reused)."""
+        started = time.monotonic()
+        while True:
+            if worker.connection.poll(self.poll_interval):
+                kind, payload = worker.connection.recv()
+                if kind == "result":
+                    return payload, True
+                if stream:
+                    (sys.stdout if kind == "stdout" else sys.stderr).write(payload)
+                continue
+
+            if cancelled is not None and cancelled.is_set():
+                return (False, ["CancelledError: another candidate finished first"]), False
+            if timeout is not None and time.monotonic() - started > timeout:
+                return (False, [f"TimeoutError: code execution exceeded the time limit of {timeout} seconds"]), False
+            if self.memory_limit_bytes is not None and worker.rss_bytes() > self.memory_limit_bytes:
+                return (False, [f"MemoryError: code execution exceeded the memory limit of {self.memory_limit_bytes // 1024 ** 2} MB"]), False
+            if not worker.process.is_alive():
+                raise EOFError
+
+    def replace_worker(self, worker):
+        worker.stop(kill=True)
+        self.workers.discard(worker)
+        with self.condition:
+            # Checkpoints died with the worker
+            for session in [session for session, owner in self.session_workers.items() if owner is worker]:
+                del self.session_workers[session]
+        return self.spawn_worker()
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            # Busy workers are killed, idle ones finish cleanly
+            for worker in list(self.workers):
+                worker.stop(kill=worker not in self.idle_workers)
+            self.workers.clear()
+            self.idle_workers.clear()
+            self.session_workers.clear()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
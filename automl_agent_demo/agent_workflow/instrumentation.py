@@ -0,0 +1,212 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 ** 2 if sys.platform == "darwin" else 1024)
+
+
+def current_rss_mb() -> float:
+    # Resident memory right now, unlike the peak it goes down when a model is released
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        return peak_rss_mb()
+
+
+class RssSampler:
+    """Samples current_rss_mb from a thread while active, the peak of a period can go down unlike ru_maxrss."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.start_mb = None
+        self.peak_mb = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    def __enter__(self):
+        self.start_mb = self.peak_mb = current_rss_mb()
+        self.thread = threading.Thread(target=self.sample, name="rss-sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+
+    @property
+    def increase_mb(self) -> float:
+        return self.peak_mb - self.start_mb
+
+
+class Span:
+    def __init__(self, kind: str, name: str, attributes: dict, parent=None):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.kind = kind  # "node", "lm" or "execution"
+        self.name = name
+        self.attributes = attributes
+        # Child spans (e.g. an execution inside a node run) inherit the session of their parent
+        if parent is not None and "session_id" in parent.attributes:
+            self.attributes.setdefault("session_id", parent.attributes["session_id"])
+        self.start = time.time()
+        self.duration = None
+        self.error = None
+
+    def as_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "kind": self.kind,
+            "name": self.name,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """Records timed spans of node runs, language model calls and code executions.
+
+    The last max_spans spans are kept in memory, optionally appended to a JSON lines file, and
+    aggregated into counters exposed in the Prometheus text format. A file grown past
+    max_jsonl_bytes is rotated to <path>.1, replacing the previous one.
+    """
+
+    # Numeric span attributes summed into Prometheus counters
+    COUNTED_ATTRIBUTES = ("prompt_tokens", "generated_tokens", "prefill_seconds", "decode_seconds")
+
+    def __init__(self, jsonl_path: str = None, max_spans: int = 10000, max_jsonl_bytes: int = 64 * 1024 ** 2):
+        self.jsonl_path = jsonl_path
+        self.max_jsonl_bytes = max_jsonl_bytes
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.totals = {}  # (kind, name) -> {"count", "errors", "seconds", attribute sums}
+
+    @contextmanager
+    def span(self, kind: str, name: str, **attributes):
+        stack = self.local.__dict__.setdefault("stack", [])
+        span = Span(kind, name, attributes, stack[-1] if stack else None)
+        stack.append(span)
+        started = time.perf_counter()
+        try:
+            yield span
+        except BaseException as error:
+            span.error = repr(error)
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            stack.pop()
+            self.record(span)
+
+    def record(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+            totals = self.totals.setdefault((span.kind, span.name), {"count": 0, "errors": 0, "seconds": 0.0})
+            totals["count"] += 1
+            totals["errors"] += span.error is not None
+            totals["seconds"] += span.duration
+            for attribute in self.COUNTED_ATTRIBUTES:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)):
+                    totals[attribute] = totals.get(attribute, 0) + value
+            if self.jsonl_path is not None:
+                with open(self.jsonl_path, "a") as spans_file:
+                    spans_file.write(json.dumps(span.as_dict(), default=str) + "\n")
+                    size = spans_file.tell()
+                if size > self.max_jsonl_bytes:
+                    os.replace(self.jsonl_path, self.jsonl_path + ".1")
+
+    def find(self, kind: str = None, **attributes) -> list:
+        with self.lock:
+            spans = list(self.spans)
+        return [
+            span for span in spans
+            if (kind is None or span.kind == kind)
+            and all(span.attributes.get(key) == value for key, value in attributes.items())
+        ]
+
+    def prometheus_text(self) -> str:
+        with self.lock:
+            totals = {key: dict(value) for key, value in self.totals.items()}
+        metrics = {
+            "count": ("automl_agent_spans_total", "Number of finished spans"),
+            "errors": ("automl_agent_span_errors_total", "Number of spans that raised"),
+            "seconds": ("automl_agent_span_seconds_total", "Total duration of the spans"),
+            "prompt_tokens": ("automl_agent_prompt_tokens_total", "Prompt tokens sent to the language model"),
+            "generated_tokens": ("automl_agent_generated_tokens_total", "Tokens generated by the language model"),
+            "prefill_seconds": ("automl_agent_prefill_seconds_total", "Time spent until the first generated token"),
+            "decode_seconds": ("automl_agent_decode_seconds_total", "Time spent generating after the first token"),
+        }
+        lines = []
+        for field, (metric, description) in metrics.items():
+            samples = [(key, value[field]) for key, value in sorted(totals.items()) if field in value]
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric} {description}")
+            lines.append(f"# TYPE {metric} counter")
+            for (kind, name), value in samples:
+                lines.append(f'{metric}{{kind="{kind}",name="{name}"}} {value}')
+        lines.append("# HELP automl_agent_peak_rss_megabytes Peak resident memory of the agent process")
+        lines.append("# TYPE automl_agent_peak_rss_megabytes gauge")
+        lines.append(f"automl_agent_peak_rss_megabytes {peak_rss_mb()}")
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port: int = 9464, host: str = "127.0.0.1"):
+        """Serve prometheus_text on http://host:port/metrics from a daemon thread, returns the server."""
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip("/") not in ("", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus_text().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        return server
+
+
+class GenerationTimer:
+    """Generation streamer telling the prefill (until the first new token) from the decode time."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.calls = 0
+
+    def put(self, value):
+        # The first call carries the prompt, the second one the first generated token
+        self.calls += 1
+        if self.calls == 2:
+            self.first_token = time.perf_counter()
+
+    def end(self):
+        pass
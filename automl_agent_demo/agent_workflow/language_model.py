@@ -1,26 +1,272 @@
+import json
+import time
 import torch
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
+from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
+from .constrained_decoding import JsonFieldsGrammar, JsonFieldsLogitsProcessor, vocabulary_texts
+from .prefix_cache import PrefixCache, to_legacy_cache
+from .speculative import SpeculativeDecoder, PromptLookupDrafter, DraftModelDrafter
+from .instrumentation import GenerationTimer, current_rss_mb
+
+# Generation arguments understood by the text-generation pipeline but not by model.generate
+PIPELINE_ONLY_ARGS = ("return_full_text",)
 
 class LanguageModel:
-    def __init__(self, model_name: str = "microsoft/Phi-3-mini-128k-instruct"):
-        
-        self.model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            device_map="auto",
-            torch_dtype="auto",
-            trust_remote_code=True,
-        )
+    def __init__(
+        self,
+        model_name: str = "microsoft/Phi-3-mini-128k-instruct",
+        prefix_cache_bytes: int = 2 * 1024 ** 3,
+        response_cache=None,
+        speculative: str = None,
+        draft_model_name: str = None,
+        tracer=None,
+        backend: str = "auto",
+        quantization: str = None,
+        num_threads: int = None,
+        compile_model: bool = False,
+    ):
+
+        self.model_name = model_name
+        # backend "auto" places the model on the available devices, "cpu" keeps it on the CPU where
+        # it can be quantized: "int8" with dynamic quantization of the linear layers, "int4" with quanto
+        if backend not in ("auto", "cpu"):
+            raise ValueError(f"Unknown backend: {backend}")
+        if quantization not in (None, "int8", "int4"):
+            raise ValueError(f"Unknown quantization: {quantization}")
+        if quantization is not None and backend != "cpu":
+            raise ValueError("Quantization is only supported by the cpu backend")
+        self.backend = backend
+        self.quantization = quantization
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.model = self.load_model(model_name)
+        if compile_model:
+            # Shapes change with every prompt and step, dynamic avoids recompiling for each of them
+            self.model.forward = torch.compile(self.model.forward, dynamic=True)
+        # Quantized weights produce different text, their responses are cached separately
+        self.cache_model_name = model_name if quantization is None else f"{model_name}:{quantization}"
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # Decoder-only models have to be left padded when prompts are batched
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
         self.model.eval()
 
-    def generate_text(self, chat_history: str, generation_args: dict) -> list:
-        
-        pipe = pipeline(
-            "text-generation",
-            model=self.model,
-            tokenizer=self.tokenizer,
+        # Past-key-values of common prompt prefixes, so only the new suffix of a prompt gets prefilled
+        self.prefix_cache = PrefixCache(prefix_cache_bytes) if prefix_cache_bytes else None
+        # Optional ResponseCache memoizing deterministic generations
+        self.response_cache = response_cache
+
+        # Optional speculative decoding of greedy single-prompt generations:
+        # "prompt_lookup" drafts from n-grams of the prompt, "draft_model" from a small local model
+        self.speculative_decoder = None
+        if speculative == "prompt_lookup":
+            drafter = PromptLookupDrafter()
+        elif speculative == "draft_model":
+            drafter = DraftModelDrafter(self.load_model(draft_model_name).eval())
+        elif speculative is not None:
+            raise ValueError(f"Unknown speculative decoding mode: {speculative}")
+        if speculative is not None:
+            self.speculative_decoder = SpeculativeDecoder(self.model, drafter, self.eos_token_ids())
+
+        # Decoded text of every token id, built on the first constrained generation, and the token
+        # masks of grammar states that later constrained generations can reuse
+        self.token_texts = None
+        self.grammar_masks = {}
+        # Optional Tracer recording a span per generation
+        self.tracer = tracer
+
+    def load_model(self, model_name: str):
+        if self.backend == "auto":
+            return AutoModelForCausalLM.from_pretrained(model_name, device_map="auto", torch_dtype="auto", trust_remote_code=True)
+
+        if self.quantization == "int4":
+            try:
+                from transformers import QuantoConfig
+                # transformers 4.41 loads QuantoConfig models with the quanto package, not optimum-quanto
+                import quanto  # noqa: F401
+            except ImportError as error:
+                raise ImportError("int4 quantization needs the quanto package") from error
+            return AutoModelForCausalLM.from_pretrained(
+                model_name, device_map="cpu", torch_dtype=torch.float32, trust_remote_code=True,
+                quantization_config=QuantoConfig(weights="int4"),
+            )
+
+        # Dynamic quantization works on float32 weights, activations are quantized on the fly
+        model = AutoModelForCausalLM.from_pretrained(model_name, device_map="cpu", torch_dtype=torch.float32, trust_remote_code=True)
+        if self.quantization == "int8":
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def generate_text(self, chat_history: list, generation_args: dict) -> str:
+        return self.generate_batch([chat_history], generation_args)[0]
+
+    def generate_batch(self, chat_histories: list, generation_args: dict) -> list:
+        """Generate responses for several chats in one padded forward pass, results are in input order."""
+        if not chat_histories:
+            return []
+
+        responses = [None] * len(chat_histories)
+        cache_keys = [None] * len(chat_histories)
+        if self.response_cache is not None and self.response_cache.is_cacheable(generation_args):
+            for index, chat_history in enumerate(chat_histories):
+                rendered_chat = self.tokenizer.apply_chat_template(chat_history, add_generation_prompt=True, tokenize=False)
+                cache_keys[index] = self.response_cache.make_key(self.cache_model_name, rendered_chat, generation_args)
+                responses[index] = self.response_cache.get(cache_keys[index])
+
+        pending = [index for index, response in enumerate(responses) if response is None]
+        if pending:
+            prompts = [self.encode_chat(chat_histories[index]) for index in pending]
+            generated = self.generate_ids(prompts, generation_args)
+            for index, ids in zip(pending, generated):
+                responses[index] = self.tokenizer.decode(ids, skip_special_tokens=True).strip()
+                if cache_keys[index] is not None:
+                    self.response_cache.put(cache_keys[index], responses[index])
+        return responses
+
+    def generate_structured(self, chat_history: list, fields: list, generation_args: dict) -> dict:
+        """Generate a flat JSON object whose keys and allowed values are enforced while decoding.
+
+        fields are (key, options) pairs as understood by JsonFieldsGrammar; every value is a string
+        or None. Returns an empty dict when the generation stopped before the object was closed.
+        """
+        if self.token_texts is None:
+            self.token_texts = vocabulary_texts(self.tokenizer)
+        prompt = self.encode_chat(chat_history)
+        processor = JsonFieldsLogitsProcessor(
+            JsonFieldsGrammar(fields), self.token_texts, len(prompt), self.eos_token_ids(), self.grammar_masks
         )
+        args = dict(generation_args, logits_processor=LogitsProcessorList([processor]))
+        generated = self.generate_ids([prompt], args)[0]
+        try:
+            return json.loads(self.tokenizer.decode(generated, skip_special_tokens=True).strip())
+        except json.JSONDecodeError:
+            return {}
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    def encode_chat(self, chat_history: list) -> list:
+        # TokenizedPrompt chats from NodeConfig come with their token ids
+        token_ids = getattr(chat_history, 'token_ids', None)
+        if token_ids is not None:
+            return list(token_ids)
+        return self.tokenizer.apply_chat_template(chat_history, add_generation_prompt=True, tokenize=True)
+
+    def generate_ids(self, prompts: list, generation_args: dict) -> list:
+        if self.tracer is None:
+            return self.run_generation(prompts, generation_args)
+
+        with self.tracer.span("lm", "generate", batch_size=len(prompts), prompt_tokens=sum(len(prompt) for prompt in prompts)) as span:
+            # Resident memory around the call, the process peak would say nothing about this generation
+            rss_before_mb = current_rss_mb()
+            timer = GenerationTimer()
+            generated = self.run_generation(prompts, dict(generation_args, streamer=timer))
+            finished = time.perf_counter()
+            eos_token_ids = set(self.eos_token_ids())
+            # Rows that finished early are padded, only count up to their end-of-sequence token
+            generated_tokens = sum(
+                next((index + 1 for index, token in enumerate(ids) if token in eos_token_ids), len(ids)) for ids in generated
+            )
+            first_token = timer.first_token or finished
+            decode_seconds = finished - first_token
+            span.attributes.update({
+                "generated_tokens": generated_tokens,
+                "prefill_seconds": first_token - timer.started,
+                "decode_seconds": decode_seconds,
+                "tokens_per_second": generated_tokens / decode_seconds if decode_seconds > 0 else None,
+                "rss_before_mb": rss_before_mb,
+                "rss_after_mb": current_rss_mb(),
+            })
+        return generated
+
+    def run_generation(self, prompts: list, generation_args: dict) -> list:
+        """Run generation for a batch of tokenized prompts and return the new token ids of each prompt.
+
+        Prompts share the longest cached prefix of their common prefix; the batch is laid out as
+        [cached prefix | left padding | suffix] so the cached keys/values can be broadcast to every row.
+        """
+        args = {key: value for key, value in generation_args.items() if key not in PIPELINE_ONLY_ARGS}
+        if self.speculative_decoder is not None and len(prompts) == 1 and self.is_greedy(args):
+            return [self.generate_speculative(prompts[0], args)]
+
+        common_length = self.common_prefix_length(prompts)
+        # At least one token of every prompt has to be fed through the model
+        shareable_length = min(common_length, min(len(prompt) for prompt in prompts) - 1)
+
+        past_key_values, cached_length = None, 0
+        if self.prefix_cache is not None:
+            past_key_values, cached_length = self.prefix_cache.lookup(prompts[0], shareable_length)
+
+        suffix_length = max(len(prompt) - cached_length for prompt in prompts)
+        input_ids, attention_mask = [], []
+        for prompt in prompts:
+            padding = suffix_length - (len(prompt) - cached_length)
+            input_ids.append(prompt[:cached_length] + [self.tokenizer.pad_token_id] * padding + prompt[cached_length:])
+            attention_mask.append([1] * cached_length + [0] * padding + [1] * (len(prompt) - cached_length))
+        input_ids = torch.tensor(input_ids, device=self.model.device)
+        attention_mask = torch.tensor(attention_mask, device=self.model.device)
+
+        if past_key_values is not None:
+            past_key_values = tuple(
+                (keys.expand(len(prompts), -1, -1, -1), values.expand(len(prompts), -1, -1, -1))
+                for keys, values in past_key_values
+            )
 
         with torch.no_grad():
-          output = pipe(chat_history, **generation_args)
-        return output[0]['generated_text'].strip()
\ No newline at end of file
+          output = self.model.generate(
+              input_ids=input_ids,
+              attention_mask=attention_mask,
+              past_key_values=past_key_values,
+              pad_token_id=self.tokenizer.pad_token_id,
+              return_dict_in_generate=True,
+              **args,
+          )
+
+        if self.prefix_cache is not None and output.past_key_values is not None:
+            # The longest prompt has no padding, so its keys/values line up with the plain token ids
+            row = max(range(len(prompts)), key=lambda index: len(prompts[index]))
+            row_past_key_values = tuple(
+                (keys[row:row + 1], values[row:row + 1]) for keys, values in to_legacy_cache(output.past_key_values)
+            )
+            max_length = len(prompts[row]) - 1 if len(prompts) == 1 else shareable_length
+            self.prefix_cache.store(prompts[row], row_past_key_values, max_length)
+
+        return [sequence[input_ids.shape[1]:].tolist() for sequence in output.sequences]
+
+    def generate_speculative(self, prompt: list, args: dict) -> list:
+        past_key_values, cached_length = None, 0
+        if self.prefix_cache is not None:
+            past_key_values, cached_length = self.prefix_cache.lookup(prompt, len(prompt) - 1)
+        max_new_tokens = args.get("max_new_tokens") or self.model.generation_config.max_new_tokens or 256
+        generated, past_key_values = self.speculative_decoder.generate(prompt, max_new_tokens, past_key_values, cached_length, args.get("streamer"))
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(prompt, past_key_values, len(prompt) - 1)
+        return generated
+
+    def speculative_stats(self) -> dict:
+        return self.speculative_decoder.stats.as_dict() if self.speculative_decoder is not None else {}
+
+    @staticmethod
+    def is_greedy(args: dict) -> bool:
+        # The speculative path does not apply logits processors, constrained generations skip it
+        return (
+            not args.get("do_sample") and args.get("num_beams", 1) == 1
+            and args.get("num_return_sequences", 1) == 1 and "logits_processor" not in args
+        )
+
+    def eos_token_ids(self) -> list:
+        eos_token_ids = self.model.generation_config.eos_token_id
+        if eos_token_ids is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_ids, int):
+            eos_token_ids = [eos_token_ids]
+        return list(eos_token_ids) + [self.tokenizer.eos_token_id]
+
+    @staticmethod
+    def common_prefix_length(prompts: list) -> int:
+        length = 0
+        for tokens in zip(*prompts):
+            if any(token != tokens[0] for token in tokens):
+                break
+            length += 1
+        return length
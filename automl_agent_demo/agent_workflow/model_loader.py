@@ -0,0 +1,56 @@
+import threading
+import time
+
+
+class BackgroundModel:
+    """Drop-in LanguageModel that is built by load_model in a background thread.
+
+    Loading starts as soon as the object is created, so the weights load while documentation is
+    fetched and the user types. Only the first call that needs the model waits for it; an error
+    raised while loading is raised again by every such call.
+    """
+
+    def __init__(self, load_model):
+        self.load_model = load_model
+        self.model = None
+        self.error = None
+        self.load_seconds = None
+        self.loaded = threading.Event()
+        self.thread = threading.Thread(target=self.load, name="model-loader", daemon=True)
+        self.thread.start()
+
+    def load(self):
+        started = time.perf_counter()
+        try:
+            self.model = self.load_model()
+        except BaseException as error:
+            self.error = error
+        finally:
+            self.load_seconds = time.perf_counter() - started
+            self.loaded.set()
+
+    def is_loaded(self) -> bool:
+        return self.loaded.is_set() and self.error is None
+
+    def wait(self, timeout: float = None):
+        if not self.loaded.wait(timeout):
+            raise TimeoutError(f"The language model did not load within {timeout} seconds")
+        if self.error is not None:
+            raise RuntimeError("Loading the language model failed") from self.error
+        return self.model
+
+    def generate_text(self, chat_history, generation_args):
+        return self.wait().generate_text(chat_history, generation_args)
+
+    def generate_batch(self, chat_histories, generation_args):
+        return self.wait().generate_batch(chat_histories, generation_args)
+
+    def count_tokens(self, text):
+        return self.wait().count_tokens(text)
+
+    def __getattr__(self, name):
+        # Only reached for attributes of the loaded model (tokenizer, caches, generate_structured when
+        # the model has it, ...), they wait for it
+        if name in ("load_model", "model", "error", "load_seconds", "loaded", "thread"):
+            raise AttributeError(name)
+        return getattr(self.wait(), name)
@@ -0,0 +1,231 @@
+import asyncio
+import os
+import threading
+import traceback
+from multiprocessing.connection import Client, Listener
+from pathlib import Path
+from .async_workflow import BatchingScheduler, ScheduledLanguageModel
+
+DEFAULT_SOCKET = str(Path.home() / ".cache" / "automl_agent" / "model.sock")
+# Calls a client may make, everything else is rejected
+SERVED_METHODS = ("generate_text", "generate_batch", "generate_structured", "count_tokens", "stats")
+
+
+class ModelServer:
+    """Serves one loaded LanguageModel to workflow processes over a Unix socket or localhost TCP.
+
+    Every client connection gets a thread; their generations queue up in a BatchingScheduler, so
+    concurrent requests with the same generation arguments share a batch. Requests are pickled, so
+    a TCP server needs an authkey and only listens on localhost.
+    """
+
+    def __init__(self, lm, address: str = DEFAULT_SOCKET, port: int = None, authkey: bytes = None, max_batch_size: int = 8, max_wait: float = 0.05):
+        if port is not None and authkey is None:
+            raise ValueError("A TCP model server needs an authkey")
+        self.address = ("127.0.0.1", port) if port is not None else address
+        self.authkey = authkey
+        self.scheduler = BatchingScheduler(lm, max_batch_size, max_wait)
+        self.lm = ScheduledLanguageModel(self.scheduler)
+        self.listener = None
+        self.loop = None
+        self.lock = threading.Lock()
+        self.queue_depth = 0  # Requests received and not answered yet
+        self.served = 0
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="scheduler", daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.scheduler.start(), self.loop).result()
+        if isinstance(self.address, str):
+            Path(self.address).parent.mkdir(parents=True, exist_ok=True)
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            # Only the user running the server may talk to it: the socket is created without group and
+            # other permissions, so nobody else can connect between binding and a later chmod
+            umask = os.umask(0o177)
+            try:
+                self.listener = Listener(self.address, "AF_UNIX", authkey=self.authkey)
+            finally:
+                os.umask(umask)
+            os.chmod(self.address, 0o600)
+        else:
+            self.listener = Listener(self.address, "AF_INET", authkey=self.authkey)
+
+    def serve_forever(self):
+        if self.listener is None:
+            self.start()
+        print(f"Model server listening on {self.address}")
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                break  # Listener closed
+            except Exception as error:
+                # A client failing the authkey handshake must not stop the server
+                print("Rejected a connection:", error)
+                continue
+            threading.Thread(target=self.handle, args=(connection,), name="client", daemon=True).start()
+
+    def handle(self, connection):
+        with connection:
+            while True:
+                try:
+                    method, args = connection.recv()
+                except (EOFError, OSError):
+                    return
+                with self.lock:
+                    self.queue_depth += 1
+                try:
+                    if method not in SERVED_METHODS:
+                        raise ValueError(f"Unknown method: {method}")
+                    response = ("ok", getattr(self, method)(*args))
+                except Exception:
+                    response = ("error", traceback.format_exc())
+                finally:
+                    with self.lock:
+                        self.queue_depth -= 1
+                        self.served += 1
+                try:
+                    connection.send(response)
+                except (EOFError, OSError):
+                    return
+
+    def generate_text(self, chat_history, generation_args):
+        return self.lm.generate_text(chat_history, generation_args)
+
+    def generate_batch(self, chat_histories, generation_args):
+        return self.lm.generate_batch(chat_histories, generation_args)
+
+    def generate_structured(self, chat_history, fields, generation_args):
+        return self.lm.generate_structured(chat_history, fields, generation_args)
+
+    def count_tokens(self, text):
+        return self.lm.count_tokens(text)
+
+    def stats(self):
+        with self.lock:
+            # The stats request itself is not counted as queued
+            return {
+                "queue_depth": self.queue_depth - 1,
+                "served": self.served,
+                "model_name": getattr(self.scheduler.lm, "model_name", None),
+                "structured": hasattr(self.scheduler.lm, "generate_structured"),
+            }
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+        if self.loop is not None:
+            asyncio.run_coroutine_threadsafe(self.scheduler.stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.loop = None
+
+
+class ModelServerError(RuntimeError):
+    pass
+
+
+class ModelClient:
+    """Drop-in LanguageModel forwarding generations to a ModelServer.
+
+    Each thread gets its own connection, so concurrent sessions of one process can be batched
+    together by the server. The tokenizer of the served model is loaded locally, prompts are
+    tokenized and counted without a round trip.
+    """
+
+    def __init__(self, address: str = DEFAULT_SOCKET, port: int = None, authkey: bytes = None):
+        self.address = ("127.0.0.1", port) if port is not None else address
+        self.family = "AF_INET" if port is not None else "AF_UNIX"
+        self.authkey = authkey
+        self.local = threading.local()
+        self.structured = None  # Whether the served model has generate_structured, asked on first use
+        self.tokenizer_lock = threading.Lock()
+        self.local_tokenizer = None
+        self.tokenizer_loaded = False
+
+    @classmethod
+    def connect_or_none(cls, address: str = DEFAULT_SOCKET, port: int = None, authkey: bytes = None):
+        # Returns a client when a server answers at address, None otherwise
+        client = cls(address, port, authkey)
+        try:
+            client.stats()
+        except (OSError, EOFError, ModelServerError):
+            return None
+        return client
+
+    def connection(self):
+        if getattr(self.local, "connection", None) is None:
+            self.local.connection = Client(self.address, self.family, authkey=self.authkey)
+        return self.local.connection
+
+    def call(self, method, *args):
+        connection = self.connection()
+        try:
+            connection.send((method, args))
+            status, value = connection.recv()
+        except (EOFError, OSError):
+            # The server went away, the next call reconnects
+            self.local.connection = None
+            raise
+        if status == "error":
+            raise ModelServerError(value)
+        return value
+
+    def generate_text(self, chat_history, generation_args):
+        return self.call("generate_text", chat_history, generation_args)
+
+    def generate_batch(self, chat_histories, generation_args):
+        return self.call("generate_batch", chat_histories, generation_args)
+
+    def __getattr__(self, name):
+        # Like the served model, the client only has generate_structured when the model supports it
+        if name == "generate_structured":
+            if self.structured is None:
+                self.structured = self.stats().get("structured", False)
+            if self.structured:
+                return self.remote_generate_structured
+        raise AttributeError(name)
+
+    def remote_generate_structured(self, chat_history, fields, generation_args):
+        # Options computed from decoded values cannot cross the socket, they are resolved here
+        # from what is already known, None leaving a field unconstrained
+        fields = [
+            (key, options((None,) * index) if callable(options) else options)
+            for index, (key, options) in enumerate(fields)
+        ]
+        return self.call("generate_structured", chat_history, fields, generation_args)
+
+    @property
+    def tokenizer(self):
+        """Tokenizer of the served model loaded in this process on first use, None when it cannot be loaded."""
+        with self.tokenizer_lock:
+            if not self.tokenizer_loaded:
+                self.tokenizer_loaded = True
+                model_name = self.stats().get("model_name")
+                if model_name:
+                    try:
+                        from transformers import AutoTokenizer
+
+                        self.local_tokenizer = AutoTokenizer.from_pretrained(model_name)
+                    except (ImportError, OSError, ValueError) as error:
+                        print(f"Counting tokens on the model server, the tokenizer of {model_name} could not be loaded: {error}")
+            return self.local_tokenizer
+
+    def count_tokens(self, text):
+        tokenizer = self.tokenizer
+        if tokenizer is None:
+            return self.call("count_tokens", text)
+        return len(tokenizer.encode(text, add_special_tokens=False))
+
+    def stats(self):
+        """Queue depth, number of served requests, model name and structured generation support of the server."""
+        return self.call("stats")
+
+    def close(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
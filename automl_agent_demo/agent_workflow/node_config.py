@@ -1,17 +1,19 @@
 import copy
 from enum import Enum, auto
+from .prompt_builder import PromptBuilder, PromptPart
 
 # Define the states for the workflow
 class NodeState(Enum):
     COLLECTING_INPUTS = auto()
     GENERATING_CODE = auto()
+    VALIDATING_CODE = auto()
     EXECUTING_CODE = auto()
     FIXING_ERRORS = auto()
     FINISHED = auto()
     MAX_RETRIES_REACHED = auto()
 
 class NodeConfig:
-    def __init__(self):
+    def __init__(self, tokenizer=None, load_tokenizer=None):
         # General generation arguments
         self.generation_args_template = {
             "return_full_text": False,
@@ -23,8 +25,29 @@ class NodeConfig:
         self.code_fix_generation_args = copy.deepcopy(self.generation_args_template)
 
         self.entity_extraction_generation_args.update({"max_new_tokens": 100})
+        # A single JSON object holding every entity, the keys are forced so they are cheap to decode
+        self.structured_extraction_generation_args = copy.deepcopy(self.generation_args_template)
+        self.structured_extraction_generation_args.update({"max_new_tokens": 160})
         self.code_generation_args.update({"max_new_tokens": 1000})
         self.code_fix_generation_args.update({"max_new_tokens": 600})
+        # Patches only touch the failing lines, so they need far fewer new tokens than a full rewrite
+        self.code_patch_generation_args = copy.deepcopy(self.generation_args_template)
+        self.code_patch_generation_args.update({"max_new_tokens": 200})
+
+        # Sampled variants used when several code candidates are generated in one batched call
+        self.code_candidate_generation_args = copy.deepcopy(self.code_generation_args)
+        self.code_candidate_generation_args.update({"do_sample": True, "temperature": 0.7, "top_p": 0.95})
+
+        # Token budget for the documentation retrieved into the code generation prompt
+        self.doc_token_budget = 3000
+        # Token budgets of whole prompts, tracebacks and documentation are truncated to fit
+        self.prompt_token_budgets = {
+            "code_gen": 4500,
+            "code_fix": 4000,
+            "code_patch": 3000,
+        }
+        # Caches the rendered chat templates, one config is shared by all nodes of a workflow
+        self.prompt_builder = PromptBuilder(tokenizer, load_tokenizer)
 
         # Prompts
         self.entity_extraction_prompt_template = [
@@ -41,20 +64,71 @@ class NodeConfig:
             {"role": "assistant", "content": None},  # Placeholder for example fixed code
             {"role": "user", "content": None},  # Placeholder for actual error message and code
         ]
+        self.code_patch_prompt_template = [
+            {"role": "system", "content": "You are a helpful, and accurate, AI assistant, that fixes python code by emitting minimal line-range patches. Follow the output format in the example"},
+            {"role": "user", "content": None},  # Placeholder for example error message and numbered code
+            {"role": "assistant", "content": None},  # Placeholder for example patch
+            {"role": "user", "content": None},  # Placeholder for actual error message and numbered code
+        ]
+
+    def get_doc_query(self, task, target_column):
+        # Terms used to retrieve the documentation chunks relevant to the user's problem
+        return f"{task} {target_column} load dataset read_csv setup compare_models evaluate_model pull"
+
+    @staticmethod
+    def error_text(errors):
+        return "".join(errors) if isinstance(errors, (list, tuple)) else str(errors)
 
     def get_code_gen_prompt(self, library_doc, task, dataset_url, target_column):
-        prompt = copy.deepcopy(self.code_gen_prompt_template)
         user_instruction = (
             f"Using the information from the documentation, write code to FIND AND EVALUATE best model for {task} on dataset located at url: {dataset_url} "
             f"and target column:{target_column} using pycaret library, don't fit it on new data. "
-            "Only generate executable code and nothing else like explanation or reasoning. DO NOT INCLUDE ANY MARKDOWN FORMATTING SUCH AS TRIPLE BACKTICKS (```PYTHON). OUTPUT SHOULD BE PLAIN PYTHON CODE."
         )
-        prompt[1]["content"] = prompt[1]["content"] + " \n " + "Library Documentation: " + library_doc + " \n " + "user_instruction: " + user_instruction
-        return prompt
+        return self.prompt_builder.build([
+            (self.code_gen_prompt_template[0]["role"], [self.code_gen_prompt_template[0]["content"]]),
+            (self.code_gen_prompt_template[1]["role"], [
+                self.code_gen_prompt_template[1]["content"] + " \n " + "Library Documentation: ",
+                PromptPart(library_doc, truncation="head"),
+                " \n " + "user_instruction: ",
+                PromptPart(user_instruction),
+                "Only generate executable code and nothing else like explanation or reasoning. DO NOT INCLUDE ANY MARKDOWN FORMATTING SUCH AS TRIPLE BACKTICKS (```PYTHON). OUTPUT SHOULD BE PLAIN PYTHON CODE.",
+            ]),
+        ], self.prompt_token_budgets["code_gen"])
+
+    @staticmethod
+    def number_lines(code):
+        return "\n".join(f"{number}| {line}" for number, line in enumerate(code.split("\n"), start=1))
+
+    def get_code_patch_prompt(self, example_err_msg, example_code_with_error, example_patch, errors, code):
+        roles = [message["role"] for message in self.code_patch_prompt_template]
+        patch_instruction = (
+            "Only output a patch and nothing else like explanation or reasoning. A patch is one or more hunks, each hunk is a header line "
+            "'@@ start-end' followed by the lines replacing lines start to end (inclusive) of the numbered code, without line numbers. "
+            "Use '@@ n-(n-1)' to insert lines before line n."
+        )
+        return self.prompt_builder.build([
+            (roles[0], [self.code_patch_prompt_template[0]["content"]]),
+            (roles[1], [f"Example: {patch_instruction} Fix this error: {example_err_msg} in the python code:\n{self.number_lines(example_code_with_error)}"]),
+            (roles[2], [example_patch]),
+            (roles[3], [
+                f"{patch_instruction} Fix this error: ",
+                PromptPart(self.error_text(errors), truncation="traceback"),
+                " in the python code:\n",
+                PromptPart(self.number_lines(code)),
+            ]),
+        ], self.prompt_token_budgets["code_patch"])
 
     def get_code_fix_prompt(self, example_err_msg, example_code_with_error, example_fixed_code, errors, code):
-        prompt = copy.deepcopy(self.code_fix_prompt_template)
-        prompt[1]["content"] = f"Example: Only generate executable code and nothing else like explanation or reasoning. Fix this error: {example_err_msg} in the python code: {example_code_with_error}."
-        prompt[2]["content"] = example_fixed_code
-        prompt[3]["content"] = f"Only generate executable code and nothing else like explanation or reasoning. DO NOT INCLUDE ANY MARKDOWN FORMATTING SUCH AS TRIPLE BACKTICKS (```PYTHON). OUTPUT SHOULD BE PLAIN PYTHON CODE. Fix this error: {errors} in the python code: {code}."
-        return prompt
\ No newline at end of file
+        roles = [message["role"] for message in self.code_fix_prompt_template]
+        return self.prompt_builder.build([
+            (roles[0], [self.code_fix_prompt_template[0]["content"]]),
+            (roles[1], [f"Example: Only generate executable code and nothing else like explanation or reasoning. Fix this error: {example_err_msg} in the python code: {example_code_with_error}."]),
+            (roles[2], [example_fixed_code]),
+            (roles[3], [
+                "Only generate executable code and nothing else like explanation or reasoning. DO NOT INCLUDE ANY MARKDOWN FORMATTING SUCH AS TRIPLE BACKTICKS (```PYTHON). OUTPUT SHOULD BE PLAIN PYTHON CODE. Fix this error: ",
+                PromptPart(self.error_text(errors), truncation="traceback"),
+                " in the python code: ",
+                PromptPart(code),
+                ".",
+            ]),
+        ], self.prompt_token_budgets["code_fix"])
@@ -1,7 +1,16 @@
-import traceback
-from .node_config import NodeConfig, NodeState
+import re
+import threading
+from .node_config import NodeState
+from .doc_index import DocumentationIndex
+from .statement_runner import StatementRunner
+from . import code_validation
+from . import code_patch
 from .user_interface import Conversation
 
+# Generated code run in the agent process patches pandas readers (dry runs, dataset cache) and uses
+# pycaret's module-global experiment, so concurrent sessions without an ExecutionPool take turns
+IN_PROCESS_EXECUTION = threading.Lock()
+
 # Base class for all nodes in the workflow
 class Node:
     def __init__(self, name, context, retries= 5):
@@ -16,6 +25,26 @@ class Node:
     def log_transition(self, source_state, dest_state):
       self.transitions.append((source_state, dest_state))
 
+    def get_state(self):
+        # What a workflow checkpoint keeps of the node, JSON serializable
+        return {"transitions": [[source_state.name, dest_state.name] for source_state, dest_state in self.transitions]}
+
+    def set_state(self, state):
+        self.transitions = [(NodeState[source_state], NodeState[dest_state]) for source_state, dest_state in state["transitions"]]
+
+    def check_formatting(self, code):
+        # Check if the code contains markdown formatting with triple backticks
+        if "```" in code:
+            # Split the code by newlines
+            lines = code.split('\n')
+            # Filter out lines that start or end with triple backticks
+            executable_lines = [line for line in lines if not line.strip().startswith('```')]
+            # Join the remaining lines back into a single string
+            return '\n'.join(executable_lines)
+        else:
+            # If no markdown formatting is detected, return the input as is
+            return code
+
 # Node for collecting inputs
 class CollectInputsNode(Node):
     def run(self):
@@ -33,9 +62,16 @@ class CollectInputsNode(Node):
 
     def collect_inputs(self):
         # Define generation arguments
-        config = NodeConfig()
+        config = self.context.config
         # Initialize Conversation
-        conversor = Conversation(self.context.lm, config.entity_extraction_generation_args, self.max_retries)
+        conversor = Conversation(
+            self.context.lm,
+            config.entity_extraction_generation_args,
+            self.max_retries,
+            self.context.dataset_cache,
+            self.context.input_fn,
+            config.structured_extraction_generation_args,
+        )
         conversor.chat(config.entity_extraction_prompt_template)
         if conversor.is_chat_successful():
           return {'dataset_url': conversor.dataset_url, 'machine_learning_task': conversor.machine_learning_task, 'target_column': conversor.target_column}
@@ -48,86 +84,301 @@ class CollectInputsNode(Node):
 
 # Node for generating code
 class GenerateCodeNode(Node):
+    def __init__(self, name, context, retries=5, num_candidates=1):
+        super().__init__(name, context, retries)
+        self.num_candidates = num_candidates
+
     def run(self):
         # Logic to generate code
 
-        config = NodeConfig()
+        config = self.context.config
         prompt = config.get_code_gen_prompt(
-            self.context.library_doc,
+            self.get_library_doc(config),
             self.context.inputs['machine_learning_task'],
             self.context.inputs['dataset_url'],
             self.context.inputs['target_column']
         )
-        self.context.code = self.generate_code(prompt, config.code_generation_args)
+        if self.num_candidates > 1:
+            # Diverse candidates from one batched sampling call, executed concurrently later on
+            candidates = self.context.lm.generate_batch([prompt] * self.num_candidates, config.code_candidate_generation_args)
+            self.context.candidates = list(dict.fromkeys(candidates))
+            self.context.code = self.context.candidates[0]
+        else:
+            self.context.code = self.generate_code(prompt, config.code_generation_args)
         # self.context.code = " " + self.context.code
         source_state = NodeState.GENERATING_CODE
-        dest_state = NodeState.EXECUTING_CODE
+        dest_state = NodeState.VALIDATING_CODE
         self.log_transition(source_state, dest_state)
         return True
 
+    def get_library_doc(self, config):
+        library_doc = self.context.library_doc
+        if isinstance(library_doc, DocumentationIndex):
+            # Only the chunks relevant to the task and target go into the prompt
+            query = config.get_doc_query(self.context.inputs['machine_learning_task'], self.context.inputs['target_column'])
+            token_counter = getattr(self.context.lm, 'count_tokens', None)
+            return library_doc.build_context(query, config.doc_token_budget, token_counter)
+        return library_doc
+
     def generate_code(self, code_gen_prompt, code_generation_args):
         # Implement code generation logic
         return self.context.lm.generate_text(code_gen_prompt, code_generation_args)
 
+# Node for validating code before the full run
+class ValidateCodeNode(Node):
+    def __init__(self, name, context, retries=5, dry_run=True, sample_fraction=0.01, min_sample_rows=200):
+        super().__init__(name, context, retries)
+        self.dry_run = dry_run
+        self.sample_fraction = sample_fraction
+        self.min_sample_rows = min_sample_rows
+
+    def run(self):
+        # Logic to validate code, failures skip the full run and go straight to fixing
+        source_state = NodeState.VALIDATING_CODE
+        if len(self.context.candidates) > 1:
+            success, errors = self.validate_candidates()
+        else:
+            success, errors = self.validate_code(self.context.code)
+        self.context.errors = errors
+        if success:
+            dest_state = NodeState.EXECUTING_CODE
+        else:
+            self.context.execution_success = False
+            dest_state = NodeState.FIXING_ERRORS
+        self.log_transition(source_state, dest_state)
+        return success
+
+    def validate_candidates(self):
+        # Candidates only get the static checks, racing them is what the full run is for
+        failures = []
+        passing = []
+        for candidate in self.context.candidates:
+            errors = code_validation.static_check(self.check_formatting(candidate))
+            if errors:
+                failures.append((candidate, errors))
+            else:
+                passing.append(candidate)
+        if not passing:
+            self.context.candidates = []
+            self.context.code, errors = failures[0]
+            return False, errors
+        self.context.candidates = passing
+        self.context.code = passing[0]
+        return True, None
+
+    def validate_code(self, code):
+        code = self.check_formatting(code)
+        # Compile, imports and name resolution are checked without running anything
+        errors = code_validation.static_check(code)
+        if errors:
+            return False, errors
+
+        # Signature checks and the dry run import the libraries, so they belong in a worker
+        target_column = self.context.inputs['target_column'] if self.context.inputs else None
+        checks = [(code_validation.check_call_signatures, (code,))]
+        if self.dry_run:
+            checks.append((code_validation.dry_run, (code, target_column, self.sample_fraction, self.min_sample_rows, self.context.dataset_cache)))
+        for check, args in checks:
+            with self.context.tracer.span("execution", check.__name__) as span:
+                if self.context.executor is not None:
+                    success, errors = self.context.executor.run_function(check, *args)
+                else:
+                    with IN_PROCESS_EXECUTION:
+                        success, errors = check(*args)
+                span.attributes["success"] = success
+            if not success:
+                return False, errors
+        return True, None
+
 # Node for executing code
 class ExecuteCodeNode(Node):
+    def __init__(self, name, context, retries=5):
+        super().__init__(name, context, retries)
+        self.runner = None  # StatementRunner used when no execution pool is configured
+        self.execution_session = None  # Pool session holding the checkpoints of the code being fixed
+
     def run(self):
         # Logic to execute code
         source_state = NodeState.EXECUTING_CODE
-        success, errors = self.execute_code(self.context.code)
+        with self.context.tracer.span("execution", "execute_code", candidates=max(len(self.context.candidates), 1)) as span:
+            if len(self.context.candidates) > 1:
+                success, errors = self.execute_candidates(self.context.candidates)
+                self.context.candidates = []
+            else:
+                success, errors = self.execute_code(self.context.code)
+            span.attributes["success"] = success
         self.context.execution_success = success
         self.context.errors = errors
         if success:
             dest_state = NodeState.FINISHED
+            # The last fix made the code run, remember it for the next time this error shows up
+            if self.context.fix_memo is not None and self.context.pending_fix is not None:
+                self.context.fix_memo.record_success(*self.context.pending_fix[:2])
+                self.context.pending_fix = None
         else:
             dest_state = NodeState.FIXING_ERRORS
         self.log_transition(source_state, dest_state)
 
         return success
-    def check_formatting(self, code):
-        # Check if the code contains markdown formatting with triple backticks
-        if "```" in code:
-            # Split the code by newlines
-            lines = code.split('\n')
-            # Filter out lines that start or end with triple backticks
-            executable_lines = [line for line in lines if not line.strip().startswith('```')]
-            # Join the remaining lines back into a single string
-            return '\n'.join(executable_lines)
+
+    def execute_candidates(self, candidates):
+        # First successful candidate wins, the others are cancelled
+        codes = [self.check_formatting(candidate) for candidate in candidates]
+        if self.context.executor is not None:
+            sessions = [f"{self.context.session_id}-{index}" for index in range(len(codes))]
+            winner, results = self.context.executor.run_first_success(codes, sessions=sessions, dataset_cache=self.context.dataset_cache)
         else:
-            # If no markdown formatting is detected, return the input as is
-            return code
-        
+            sessions = [None] * len(codes)
+            winner, results = None, [None] * len(codes)
+            for index, code in enumerate(codes):
+                results[index] = self.execute_code(code)
+                if results[index][0]:
+                    winner = index
+                    break
+
+        if winner is not None:
+            print(f"Candidate {winner + 1} of {len(codes)} executed successfully:")
+            print(codes[winner])
+            self.context.code = codes[winner]
+            return results[winner]
+
+        # All candidates failed, fix the one that got furthest through its statements
+        chosen = max(
+            (index for index, result in enumerate(results) if result is not None),
+            key=lambda index: self.failing_line(results[index][1]),
+        )
+        self.context.code = codes[chosen]
+        if sessions[chosen] is not None:
+            self.execution_session = sessions[chosen]
+        return results[chosen]
+
+    @staticmethod
+    def failing_line(errors):
+        lines = re.findall(r'File "<string>", line (\d+)', "".join(errors or []))
+        return int(lines[-1]) if lines else 0
+
     def execute_code(self, code):
         code = self.check_formatting(code)
-        # code execution logic
-        try:
-            print(code)
-            exec(code)
-            return True, None  # Indicate successful execution
-        except Exception as e:
-            error_message = str(traceback.format_exc())
-            return False, [error_message]
+        print(code)
+        # Prefer the warm worker pool, it keeps runaway code out of the agent process
+        if self.context.executor is not None:
+            session = self.execution_session or self.context.session_id
+            return self.context.executor.run(code, session=session, dataset_cache=self.context.dataset_cache)
+        # code execution logic, resuming from the statement checkpoints of the previous attempt
+        if self.runner is None:
+            self.runner = StatementRunner()
+        with IN_PROCESS_EXECUTION:
+            if self.context.dataset_cache is not None:
+                with self.context.dataset_cache.redirect_reads():
+                    return self.runner.run(code)
+            return self.runner.run(code)
 
 # Node for fixing errors
 class FixErrorsNode(Node):
-    def __init__(self, name, context, max_retries=3):
+    # Fixes changing more lines than this are too specific to be replayed on other code
+    MAX_MEMO_FIX_LINES = 10
+
+    def __init__(self, name, context, max_retries=3, patch_mode=False):
         super().__init__(name, context)
         self.retries = 0
         self.max_retries = max_retries
+        self.patch_mode = patch_mode
+        self.tried_memo_fixes = set()
 
     def run(self):
         # Logic to fix errors
         source_state = NodeState.FIXING_ERRORS
-        self.context.fixed_code = self.fix_errors(self.context.errors, self.context.code)
+        code = self.check_formatting(self.context.code)
+        signature = code_patch.error_signature(self.context.errors, code)
+        statement = code_patch.failing_statement(self.context.errors, code)
+        self.confirm_pending_fix(statement)
+
+        fixed_code = self.apply_memo_fix(signature, statement, code)
+        if fixed_code is None:
+            if self.patch_mode:
+                fixed_code = self.patch_errors(self.context.errors, code)
+            else:
+                fixed_code = self.fix_errors(self.context.errors, code)
+            replacements = code_patch.to_replacements(code, self.check_formatting(fixed_code))
+            if sum(len(old_lines) for old_lines, _ in replacements) <= self.MAX_MEMO_FIX_LINES:
+                self.context.pending_fix = (signature, replacements, statement)
+            else:
+                self.context.pending_fix = None
+        self.context.fixed_code = fixed_code
         self.context.code = self.context.fixed_code
         self.retries += 1
         if self.retries >= self.max_retries:
             dest_state = NodeState.MAX_RETRIES_REACHED
         else:
-            dest_state = NodeState.EXECUTING_CODE
+            dest_state = NodeState.VALIDATING_CODE
         self.log_transition(source_state, dest_state)
         return self.retries < self.max_retries
 
+    def get_state(self):
+        state = super().get_state()
+        # Retries survive a restart, so a resumed workflow still stops after max_retries fixes
+        state["retries"] = self.retries
+        state["tried_memo_fixes"] = sorted(self.tried_memo_fixes)
+        return state
+
+    def set_state(self, state):
+        super().set_state(state)
+        self.retries = state.get("retries", 0)
+        self.tried_memo_fixes = {tuple(key) for key in state.get("tried_memo_fixes", [])}
+
+    def confirm_pending_fix(self, statement):
+        # A previous fix worked if execution now fails at a later statement; an error moving elsewhere
+        # (e.g. a patch turning a TypeError into a SyntaxError or NameError) does not count
+        pending_fix = self.context.pending_fix
+        if pending_fix is not None and self.context.fix_memo is not None:
+            signature, replacements, fixed_statement = pending_fix
+            if statement is not None and fixed_statement is not None and statement > fixed_statement:
+                self.context.fix_memo.record_success(signature, replacements)
+        self.context.pending_fix = None
+
+    def apply_memo_fix(self, signature, statement, code):
+        # Replay fixes that solved the same error before, without calling the model
+        if self.context.fix_memo is None:
+            return None
+        for replacements in self.context.fix_memo.candidates(signature):
+            key = (signature, repr(replacements))
+            if key in self.tried_memo_fixes:
+                continue
+            self.tried_memo_fixes.add(key)
+            fixed_code = code_patch.apply_replacements(code, replacements)
+            if fixed_code is not None and fixed_code != code:
+                print("Applying a remembered fix for:", signature)
+                self.context.pending_fix = (signature, replacements, statement)
+                return fixed_code
+        return None
+
+    def patch_errors(self, errors, code):
+        # Ask for a compact line-range patch instead of the whole script
+        example_err_msg = (
+            "Traceback (most recent call last):\n"
+            '  File "<string>", line 5, in <module>\n'
+            "NameError: name 'adde_two_numbers' is not defined"
+        )
+        example_code_with_error = (
+            "def add_two_numbers(a, b):\n"
+            "    return a + b\n"
+            "a = 10\n"
+            "b = 5\n"
+            "print(adde_two_numbers(a, b))"
+        )
+        example_patch = (
+            "@@ 5-5\n"
+            "print(add_two_numbers(a, b))"
+        )
+        config = self.context.config
+        prompt = config.get_code_patch_prompt(example_err_msg, example_code_with_error, example_patch, errors, code)
+        response = self.context.lm.generate_text(prompt, config.code_patch_generation_args)
+        try:
+            return code_patch.apply_patch(code, code_patch.parse_patch(response))
+        except code_patch.PatchError as error:
+            print("Falling back to a full rewrite, the patch could not be applied:", error)
+            return self.fix_errors(errors, code)
+
     def fix_errors(self, errors, code):
         # Implement error fixing logic
         example_err_msg = (
@@ -154,11 +405,12 @@ class FixErrorsNode(Node):
             "b = 5\n"
             "print(add_two_numbers(a, b))"
         )
-        prompt = NodeConfig().get_code_fix_prompt(
+        config = self.context.config
+        prompt = config.get_code_fix_prompt(
             example_err_msg,
             example_code_with_error,
             example_fixed_code,
             errors,
             code
         )
-        return self.context.lm.generate_text(prompt, NodeConfig().code_fix_generation_args)
\ No newline at end of file
+        return self.context.lm.generate_text(prompt, config.code_fix_generation_args)
\ No newline at end of file
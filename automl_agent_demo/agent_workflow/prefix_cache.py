@@ -0,0 +1,102 @@
+from collections import OrderedDict
+
+class PrefixCache:
+    """LRU cache of past-key-values for prompt prefixes, keyed by a chained hash of token blocks.
+
+    Prefixes are stored at block granularity so that any prompt sharing the first N blocks of a
+    cached prompt (system message, few-shot example, library documentation...) can reuse them.
+    """
+
+    def __init__(self, max_bytes: int = 2 * 1024 ** 3, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.entries = OrderedDict()  # entry key -> (token ids, past key values, nbytes)
+        self.block_index = {}  # block hash -> entry key holding that prefix
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def block_hashes(self, token_ids, max_length=None):
+        max_length = len(token_ids) if max_length is None else min(max_length, len(token_ids))
+        hashes = []
+        previous = None
+        for end in range(self.block_size, max_length + 1, self.block_size):
+            previous = hash((previous, tuple(token_ids[end - self.block_size:end])))
+            hashes.append(previous)
+        return hashes
+
+    def lookup(self, token_ids, max_length=None):
+        """Return (past_key_values, length) for the longest cached prefix of token_ids no longer than max_length."""
+        hashes = self.block_hashes(token_ids, max_length)
+        for block in range(len(hashes) - 1, -1, -1):
+            key = self.block_index.get(hashes[block])
+            if key is None:
+                continue
+            cached_ids, past_key_values, _ = self.entries[key]
+            length = (block + 1) * self.block_size
+            # Guard against hash collisions before handing the keys/values out
+            if list(cached_ids[:length]) != list(token_ids[:length]):
+                continue
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return crop_past_key_values(past_key_values, length), length
+        self.misses += 1
+        return None, 0
+
+    def store(self, token_ids, past_key_values, max_length=None):
+        """Cache the past-key-values of the longest block-aligned prefix of token_ids that fits in max_bytes."""
+        hashes = self.block_hashes(token_ids, max_length)
+        # Sized from the tensor shapes, nothing is copied for prefixes the budget cannot hold
+        bytes_per_token = sum(
+            (keys.numel() // keys.shape[2]) * keys.element_size() + (values.numel() // values.shape[2]) * values.element_size()
+            for keys, values in past_key_values
+        )
+        hashes = hashes[:self.max_bytes // (bytes_per_token * self.block_size)]
+        if not hashes:
+            return
+        key = hashes[-1]
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        length = len(hashes) * self.block_size
+        past_key_values = tuple(
+            (keys[:, :, :length].clone(), values[:, :, :length].clone())
+            for keys, values in past_key_values
+        )
+        nbytes = bytes_per_token * length
+
+        self.entries[key] = (tuple(token_ids[:length]), past_key_values, nbytes)
+        self.total_bytes += nbytes
+        for block_hash in hashes:
+            self.block_index[block_hash] = key
+        self.evict()
+
+    def evict(self):
+        # Drop least recently used prefixes until the cache fits in its memory budget
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, (cached_ids, _, nbytes) = self.entries.popitem(last=False)
+            self.total_bytes -= nbytes
+            for block_hash in self.block_hashes(cached_ids):
+                if self.block_index.get(block_hash) == key:
+                    del self.block_index[block_hash]
+            # Shorter prefixes of the evicted entry may still be held by other entries
+            for other_key, (other_ids, _, _) in self.entries.items():
+                for block_hash in self.block_hashes(other_ids):
+                    self.block_index.setdefault(block_hash, other_key)
+
+    def clear(self):
+        self.entries.clear()
+        self.block_index.clear()
+        self.total_bytes = 0
+
+
+def crop_past_key_values(past_key_values, length):
+    return tuple((keys[:, :, :length], values[:, :, :length]) for keys, values in past_key_values)
+
+
+def to_legacy_cache(past_key_values):
+    # Newer transformers versions return Cache objects, the prefix cache works on tuples
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return past_key_values
@@ -0,0 +1,173 @@
+import bisect
+import re
+
+# Marks where message contents go when the chat template is rendered once per role sequence
+CONTENT_MARKER = re.compile(r"\x00(\d+)\x00")
+
+
+class PromptPart:
+    """A piece of message content.
+
+    truncation says how a part may shrink when the prompt is over budget: None never truncates it,
+    "head" keeps its beginning (documentation) and "traceback" keeps the first lines and the last
+    frames.
+    """
+
+    def __init__(self, text: str, truncation: str = None, min_tokens: int = 64):
+        self.text = text or ""
+        self.truncation = truncation
+        self.min_tokens = min_tokens
+
+
+class TokenizedPrompt(list):
+    """Chat messages that also carry their token ids, so the model can skip the chat template.
+
+    It is a plain list of {"role", "content"} messages for everything else (response cache keys,
+    language models without a tokenizer).
+    """
+
+    def __init__(self, messages, token_ids=None, num_tokens=0):
+        super().__init__(messages)
+        self.token_ids = token_ids
+        self.num_tokens = num_tokens
+
+
+class PromptBuilder:
+    """Builds chat prompts that fit a token budget, with the token ids the model is going to see.
+
+    The chat template is rendered once per sequence of roles and split around the message
+    contents. A prompt is the rendered text tokenized as a whole, exactly like
+    apply_chat_template(..., tokenize=True) would, and the offsets of its tokens tell how many
+    tokens every part takes. Over budget, parts are truncated and the prompt is tokenized once
+    more. Without a tokenizer, prompts are plain messages and tokens are estimated from the
+    length of the text.
+    """
+
+    # Parts shrink in this order when a prompt is over budget: documentation before tracebacks
+    TRUNCATION_ORDER = ("head", "traceback")
+
+    def __init__(self, tokenizer=None, load_tokenizer=None):
+        self.tokenizer = tokenizer
+        # Returns the tokenizer when the first prompt is built, for models loading in the background
+        self.load_tokenizer = load_tokenizer
+        self.frames = {}  # roles -> template text around the contents
+
+    def resolve_tokenizer(self):
+        if self.load_tokenizer is not None:
+            self.tokenizer = self.load_tokenizer()
+            self.load_tokenizer = None
+
+    def encode(self, text: str) -> list:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def count_tokens(self, text: str) -> int:
+        # An estimate for truncating, the text of a part is tokenized in its context when it is used
+        self.resolve_tokenizer()
+        # Rounded up, so per-line estimates add up to at least the estimate of the joined text
+        return len(self.encode(text)) if self.tokenizer is not None else -(-len(text) // 4)
+
+    def frame(self, roles: tuple) -> list:
+        # [text, message index, text, message index, ..., text]
+        if roles not in self.frames:
+            rendered = self.tokenizer.apply_chat_template(
+                [{"role": role, "content": f"\x00{index}\x00"} for index, role in enumerate(roles)],
+                add_generation_prompt=True,
+                tokenize=False,
+            )
+            pieces = CONTENT_MARKER.split(rendered)
+            self.frames[roles] = [int(piece) if index % 2 else piece for index, piece in enumerate(pieces)]
+        return self.frames[roles]
+
+    def tokenize(self, frame: list, messages: list):
+        """Token ids of the prompt and the number of tokens of every part (by id of the part)."""
+        text, spans = "", {}
+        for piece in frame:
+            if isinstance(piece, str):
+                text += piece
+                continue
+            for part in messages[piece][1]:
+                spans[id(part)] = (len(text), len(text) + len(part.text))
+                text += part.text
+        if not getattr(self.tokenizer, "is_fast", False):
+            # Slow tokenizers have no offsets, parts are estimated on their own
+            return self.encode(text), {key: self.count_tokens(text[start:end]) for key, (start, end) in spans.items()}
+        encoding = self.tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        # A token belongs to the part its first character is in
+        starts = [start for start, _ in encoding["offset_mapping"]]
+        lengths = {key: bisect.bisect_left(starts, end) - bisect.bisect_left(starts, start) for key, (start, end) in spans.items()}
+        return encoding["input_ids"], lengths
+
+    def build(self, messages: list, token_budget: int = None) -> TokenizedPrompt:
+        """messages are (role, [PromptPart or str]) pairs, plain strings are never truncated."""
+        self.resolve_tokenizer()
+        messages = [(role, [part if isinstance(part, PromptPart) else PromptPart(part) for part in parts]) for role, parts in messages]
+        parts = [part for _, message_parts in messages for part in message_parts]
+
+        if self.tokenizer is None:
+            lengths = [self.count_tokens(part.text) for part in parts]
+            if token_budget is not None:
+                self.fit(parts, lengths, token_budget)
+            chat = [{"role": role, "content": "".join(part.text for part in message_parts)} for role, message_parts in messages]
+            return TokenizedPrompt(chat, None, sum(self.count_tokens(part.text) for part in parts))
+
+        frame = self.frame(tuple(role for role, _ in messages))
+        token_ids, part_lengths = self.tokenize(frame, messages)
+        if token_budget is not None:
+            lengths = [part_lengths[id(part)] for part in parts]
+            frame_length = len(token_ids) - sum(lengths)
+            if self.fit(parts, lengths, token_budget - frame_length):
+                token_ids, _ = self.tokenize(frame, messages)
+
+        chat = [{"role": role, "content": "".join(part.text for part in message_parts)} for role, message_parts in messages]
+        return TokenizedPrompt(chat, token_ids, len(token_ids))
+
+    def fit(self, parts: list, lengths: list, token_budget: int) -> list:
+        """Truncate parts in place until they fit token_budget, returns the truncated parts."""
+        overflow = sum(lengths) - token_budget
+        truncated = []
+        for truncation in self.TRUNCATION_ORDER:
+            for part, length in zip(parts, lengths):
+                if overflow <= 0:
+                    return truncated
+                if part.truncation != truncation or length <= part.min_tokens:
+                    continue
+                target = max(part.min_tokens, length - overflow)
+                if truncation == "traceback":
+                    part.text = self.truncate_traceback(part.text, target)
+                else:
+                    part.text = self.truncate_head(part.text, target)
+                overflow -= length - self.count_tokens(part.text)
+                truncated.append(part)
+        if overflow > 0:
+            print(f"Prompt exceeds its budget of {token_budget} tokens by {overflow} tokens after truncation")
+        return truncated
+
+    def truncate_head(self, text: str, max_tokens: int) -> str:
+        # Keep whole lines from the start, the marker says something was dropped
+        marker = "\n... (truncated)"
+        budget = max_tokens - self.count_tokens(marker)
+        kept, used = [], 0
+        for line in text.split("\n"):
+            tokens = self.count_tokens(line + "\n")
+            if used + tokens > budget:
+                break
+            kept.append(line)
+            used += tokens
+        return "\n".join(kept) + marker
+
+    def truncate_traceback(self, text: str, max_tokens: int, head_lines: int = 3) -> str:
+        # The first lines say where execution started, the last frames and the exception say what failed
+        lines = text.rstrip("\n").split("\n")
+        head = lines[:head_lines]
+        budget = max_tokens - self.count_tokens("\n".join(head) + f"\n    ... {len(lines)} lines truncated ...\n")
+        tail, used = [], 0
+        for line in reversed(lines[head_lines:]):
+            tokens = self.count_tokens(line + "\n")
+            if used + tokens > budget and tail:
+                break
+            tail.insert(0, line)
+            used += tokens
+        dropped = len(lines) - len(head) - len(tail)
+        if dropped <= 0:
+            return text
+        return "\n".join(head + [f"    ... {dropped} lines truncated ..."] + tail)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+class ResponseCache:
+    """Content-addressed cache of deterministic generations.
+
+    Responses are kept in an in-memory LRU and, when a path is given, in a sqlite file so
+    identical requests are served across sessions without touching the model.
+    """
+
+    def __init__(self, path: str = None, max_memory_entries: int = 256, max_disk_bytes: int = 512 * 1024 ** 2):
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.connection = None
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses "
+                "(key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+            )
+            self.connection.commit()
+
+    @staticmethod
+    def make_key(model_name: str, rendered_chat: str, generation_args: dict) -> str:
+        payload = json.dumps(
+            {"model": model_name, "chat": rendered_chat, "args": generation_args},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable(generation_args: dict) -> bool:
+        # Only greedy decoding is reproducible for a given model, chat and arguments
+        return generation_args.get("do_sample") is False
+
+    def get(self, key: str):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if self.connection is not None:
+                row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                    self.connection.commit()
+                    self.remember(key, row[0])
+                    self.hits += 1
+                    return row[0]
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, response: str):
+        with self.lock:
+            self.remember(key, response)
+            if self.connection is not None:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                    (key, response, len(response.encode("utf-8")), time.time()),
+                )
+                self.evict_disk()
+                self.connection.commit()
+
+    def remember(self, key: str, response: str):
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict_disk(self):
+        # Delete the least recently used responses until the store fits in max_disk_bytes
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_disk_bytes:
+            return
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access ASC").fetchall()
+        stale_keys = []
+        for key, size in rows:
+            if total_size <= self.max_disk_bytes:
+                break
+            stale_keys.append((key,))
+            total_size -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+
+    def stats(self) -> dict:
+        with self.lock:
+            disk_entries = 0
+            if self.connection is not None:
+                disk_entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_entries": len(self.memory),
+                "disk_entries": disk_entries,
+            }
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
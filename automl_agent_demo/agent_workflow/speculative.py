@@ -0,0 +1,137 @@
+import torch
+from .prefix_cache import crop_past_key_values, to_legacy_cache
+
+class SpeculativeStats:
+    def __init__(self):
+        self.proposed = 0  # Draft tokens sent for verification
+        self.accepted = 0  # Draft tokens the model agreed with
+        self.verification_steps = 0  # Forward passes of the target model after prefill
+        self.generated = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_step(self) -> float:
+        return self.generated / self.verification_steps if self.verification_steps else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "proposed": self.proposed,
+            "accepted": self.accepted,
+            "verification_steps": self.verification_steps,
+            "generated": self.generated,
+            "acceptance_rate": self.acceptance_rate,
+            "tokens_per_step": self.tokens_per_step,
+        }
+
+
+class PromptLookupDrafter:
+    """Drafts the continuation of the latest n-gram match in the prompt and the text generated so far."""
+
+    def __init__(self, max_ngram: int = 3, num_draft_tokens: int = 10):
+        self.max_ngram = max_ngram
+        self.num_draft_tokens = num_draft_tokens
+
+    def propose(self, token_ids: list) -> list:
+        for ngram in range(min(self.max_ngram, len(token_ids) - 1), 0, -1):
+            suffix = token_ids[-ngram:]
+            # Most recent earlier occurrence first, it is the most likely to be copied next
+            for start in range(len(token_ids) - ngram - 1, -1, -1):
+                if token_ids[start:start + ngram] == suffix:
+                    continuation = token_ids[start + ngram:start + ngram + self.num_draft_tokens]
+                    if continuation:
+                        return continuation
+        return []
+
+
+class DraftModelDrafter:
+    """Drafts tokens greedily with a small model sharing the tokenizer of the target model.
+
+    The draft model's past-key-values are kept between steps and cropped to the tokens the next
+    call shares with the cached ones, so rejected draft tokens are dropped and only new tokens
+    are prefilled.
+    """
+
+    def __init__(self, model, num_draft_tokens: int = 5):
+        self.model = model
+        self.num_draft_tokens = num_draft_tokens
+        self.past_key_values = None
+        self.cached_ids = []  # Token ids covered by past_key_values
+
+    def forward(self, token_ids: list) -> int:
+        input_ids = torch.tensor([token_ids], device=self.model.device)
+        output = self.model(input_ids=input_ids, past_key_values=self.past_key_values, use_cache=True)
+        self.past_key_values = to_legacy_cache(output.past_key_values)
+        self.cached_ids = self.cached_ids + token_ids
+        return output.logits[0, -1].argmax().item()
+
+    def propose(self, token_ids: list) -> list:
+        # At least the last token is fed again, its logits give the first draft token
+        shared = 0
+        for cached, token in zip(self.cached_ids, token_ids[:-1]):
+            if cached != token:
+                break
+            shared += 1
+        if shared:
+            self.past_key_values = crop_past_key_values(self.past_key_values, shared)
+        else:
+            self.past_key_values = None
+        self.cached_ids = self.cached_ids[:shared]
+
+        with torch.no_grad():
+            draft = [self.forward(token_ids[shared:])]
+            while len(draft) < self.num_draft_tokens:
+                draft.append(self.forward(draft[-1:]))
+        return draft
+
+
+class SpeculativeDecoder:
+    """Greedy decoding that verifies drafted tokens in one forward pass and keeps the agreeing prefix.
+
+    The output is identical to plain greedy decoding; every verification step yields at least one
+    token, plus one more per accepted draft token.
+    """
+
+    def __init__(self, model, drafter, eos_token_ids):
+        self.model = model
+        self.drafter = drafter
+        self.eos_token_ids = set(eos_token_ids)
+        self.stats = SpeculativeStats()
+
+    def forward(self, token_ids, past_key_values):
+        input_ids = torch.tensor([token_ids], device=self.model.device)
+        output = self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+        return output.logits[0].argmax(dim=-1).tolist(), to_legacy_cache(output.past_key_values)
+
+    def generate(self, prompt: list, max_new_tokens: int, past_key_values=None, cached_length: int = 0, streamer=None):
+        """Return (new token ids, past-key-values covering the prompt and the accepted tokens)."""
+        # Like model.generate, the streamer gets the prompt first and then the generated tokens
+        if streamer is not None:
+            streamer.put(prompt)
+        with torch.no_grad():
+            predictions, past_key_values = self.forward(prompt[cached_length:], past_key_values)
+            generated = [predictions[-1]]
+            if streamer is not None:
+                streamer.put(generated)
+            while len(generated) < max_new_tokens and generated[-1] not in self.eos_token_ids:
+                draft = self.drafter.propose(prompt + generated)[:max_new_tokens - len(generated)]
+                # The last generated token has not been through the model yet, it leads the batch
+                predictions, past_key_values = self.forward([generated[-1]] + draft, past_key_values)
+                accepted = 0
+                while accepted < len(draft) and draft[accepted] == predictions[accepted]:
+                    accepted += 1
+                # Keys/values of rejected draft tokens are dropped
+                past_key_values = crop_past_key_values(past_key_values, len(prompt) + len(generated) + accepted)
+
+                self.stats.proposed += len(draft)
+                self.stats.accepted += accepted
+                self.stats.verification_steps += 1
+                for token in draft[:accepted] + [predictions[accepted]]:
+                    generated.append(token)
+                    if token in self.eos_token_ids:
+                        break
+        generated = generated[:max_new_tokens]
+        self.stats.generated += len(generated)
+        return generated, past_key_values
@@ -0,0 +1,182 @@
+import ast
+import copy
+import gc
+import sys
+import traceback
+
+# Containers checked one level deep for objects changed by a statement
+CONTAINER_TYPES = (list, tuple, dict, set)
+
+class StatementRunner:
+    """Executes code one top-level statement at a time, checkpointing the namespace after each one.
+
+    When a later version of the code shares an unchanged statement prefix with the previous run,
+    execution resumes from the snapshot taken before the first changed statement instead of
+    replaying the whole script (data loading, pycaret setup...). Statements are compared on
+    their AST, so formatting and comment changes do not invalidate checkpoints.
+
+    A snapshot only copies the values a statement rebound or may have changed, the others are
+    shared with the previous snapshot, and all snapshots together hold at most max_snapshot_bytes
+    of copies (estimated); the oldest are dropped first and a statement whose copies alone would
+    not fit gets no snapshot.
+    """
+
+    def __init__(self, max_snapshots: int = 8, max_snapshot_bytes: int = 1024 ** 3):
+        self.max_snapshots = max_snapshots
+        self.max_snapshot_bytes = max_snapshot_bytes
+        self.statement_keys = []  # AST dumps of the statements that ran successfully, in order
+        self.snapshots = {0: {}}  # number of statements executed -> namespace snapshot
+        self.sizes = {}  # id of a copied value -> estimated bytes
+        self.last_snapshot = None  # name -> copy, of the latest snapshot of the current run
+        self.live = None  # name -> value in the namespace when last_snapshot was taken
+
+    def run(self, code: str):
+        try:
+            statements = ast.parse(code).body
+        except SyntaxError:
+            return False, [traceback.format_exc()]
+
+        keys = [ast.dump(statement) for statement in statements]
+        resume_at = self.resume_point(keys)
+        if resume_at:
+            print(f"Resuming execution from checkpoint at statement {resume_at + 1} of {len(statements)}")
+
+        namespace = {"__name__": "__main__"}
+        restored = self.copy_namespace(self.snapshots[resume_at])
+        namespace.update(restored)
+        self.last_snapshot, self.live = self.snapshots[resume_at], restored
+        del self.statement_keys[resume_at:]
+        for count in list(self.snapshots):
+            if count > resume_at:
+                del self.snapshots[count]
+
+        try:
+            for statement, key in zip(statements[resume_at:], keys[resume_at:]):
+                try:
+                    exec(compile(ast.Module(body=[statement], type_ignores=[]), "<string>", "exec"), namespace)
+                except Exception:
+                    return False, [traceback.format_exc()]
+                self.statement_keys.append(key)
+                self.take_snapshot(namespace, statement)
+            return True, None
+        finally:
+            # Values rebound away must not be kept alive until the next run
+            self.last_snapshot, self.live = None, None
+
+    def resume_point(self, keys):
+        # Length of the unchanged statement prefix, limited to the snapshots still held
+        shared = 0
+        for previous, current in zip(self.statement_keys, keys):
+            if previous != current:
+                break
+            shared += 1
+        # The last statement always runs again, there is nothing after it to resume
+        shared = min(shared, len(keys) - 1) if keys else 0
+        return max(count for count in self.snapshots if count <= shared)
+
+    def changed_names(self, namespace, statement):
+        """Names whose value the statement rebound or may have changed in place."""
+        names = {name for name in namespace if name != "__builtins__"}
+        if self.live is None:
+            return names
+        referenced = {node.id for node in ast.walk(statement) if isinstance(node, ast.Name)}
+        for name in referenced & names:
+            # Functions and objects of the code itself can change any global
+            if getattr(type(namespace[name]), "__module__", None) == "__main__" or getattr(namespace[name], "__module__", None) == "__main__":
+                return names
+        changed = {
+            name for name in names
+            if name in referenced or name not in self.live or namespace[name] is not self.live[name]
+        }
+        # Aliases and containers of changed objects changed with them
+        changed_ids = {id(namespace[name]) for name in changed}
+        for name in names - changed:
+            value = namespace[name]
+            if id(value) in changed_ids or (
+                isinstance(value, CONTAINER_TYPES) and any(id(item) in changed_ids for item in gc.get_referents(value))
+            ):
+                changed.add(name)
+        return changed
+
+    def take_snapshot(self, namespace, statement):
+        changed = self.changed_names(namespace, statement)
+        if sum(estimate_bytes(namespace[name]) for name in changed) > self.max_snapshot_bytes:
+            # Not even this snapshot fits, the next one compares against the whole namespace
+            print(f"Namespace too large to checkpoint after statement {len(self.statement_keys)}")
+            self.last_snapshot, self.live = None, None
+            return
+
+        # One memo for all values keeps aliases aliased, unchanged values map to their previous copy
+        memo = {}
+        snapshot = {}
+        for name, value in namespace.items():
+            if name != "__builtins__" and name not in changed:
+                snapshot[name] = self.last_snapshot[name]
+                memo[id(value)] = snapshot[name]
+        for name in changed:
+            value = namespace[name]
+            try:
+                snapshot[name] = copy.deepcopy(value, memo)
+            except Exception:
+                # Modules, open handles and other uncopyable objects are shared by reference
+                snapshot[name] = value
+                continue
+            if snapshot[name] is not value:
+                self.sizes[id(snapshot[name])] = estimate_bytes(value)
+
+        self.snapshots[len(self.statement_keys)] = snapshot
+        self.last_snapshot, self.live = snapshot, {name: namespace[name] for name in snapshot}
+        # Keep the empty namespace and the most recent checkpoints, fixes mostly touch late statements
+        recent = sorted(count for count in self.snapshots if count)[-self.max_snapshots:]
+        for count in list(self.snapshots):
+            if count and count not in recent:
+                del self.snapshots[count]
+        while self.held_bytes() > self.max_snapshot_bytes and len(self.snapshots) > 1:
+            del self.snapshots[min(count for count in self.snapshots if count)]
+        if len(self.statement_keys) not in self.snapshots:
+            self.last_snapshot, self.live = None, None
+
+    def held_bytes(self):
+        held = {id(value) for snapshot in self.snapshots.values() for value in snapshot.values()}
+        self.sizes = {key: size for key, size in self.sizes.items() if key in held}
+        return sum(self.sizes.values())
+
+    @staticmethod
+    def copy_namespace(namespace):
+        snapshot = {}
+        memo = {}
+        for name, value in namespace.items():
+            if name == "__builtins__":
+                continue
+            try:
+                snapshot[name] = copy.deepcopy(value, memo)
+            except Exception:
+                # Modules, open handles and other uncopyable objects are shared by reference
+                snapshot[name] = value
+        return snapshot
+
+
+def estimate_bytes(value, depth=3, seen=None):
+    """Rough size of a deep copy of value: buffers of frames and arrays, then attributes and items."""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    try:
+        if hasattr(value, "memory_usage") and hasattr(value, "dtypes"):
+            usage = value.memory_usage(deep=True)
+            return int(usage.sum()) if hasattr(usage, "sum") else int(usage)
+        if hasattr(value, "nbytes") and hasattr(value, "dtype"):
+            return int(value.nbytes)
+    except Exception:
+        pass
+    size = sys.getsizeof(value, 0)
+    if depth == 0:
+        return size
+    if isinstance(value, dict):
+        items = list(value.keys()) + list(value.values())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = list(value)
+    else:
+        items = list(getattr(value, "__dict__", {}).values())
+    return size + sum(estimate_bytes(item, depth - 1, seen) for item in items)
@@ -1,56 +1,126 @@
-import pandas as pd
 import copy
+from .dataset_cache import DatasetCache
 from .input_validation import DatasetLocationModel
 
 class Conversation:
-    def __init__(self, language_model, generation_args, max_retries=5):
+    def __init__(self, language_model, generation_args, max_retries=5, dataset_cache=None, input_fn=input, structured_generation_args=None):
         self.lm = language_model
+        self.input_fn = input_fn
+        self.dataset_cache = dataset_cache
         self.generation_args = generation_args
+        self.structured_generation_args = structured_generation_args or generation_args
         self.max_retries = max_retries
         self.dataset_url = None
         self.machine_learning_task = None
         self.target_column = None
+        self.known_columns = {}  # dataset location -> column names, or None when they could not be read
         self.supported_ml_tasks = ['classification', 'regression', 'clustering']
 
     def extract_entities(self, user_input, entity_extraction_prompt_template):
       """Given user input, extract the dataset URL, machine learning task, and target column."""
 
-      # Generate prompt for entity extraction
-      dataset_input_prompt = copy.deepcopy(entity_extraction_prompt_template)
-      machine_learning_task_input_prompt = copy.deepcopy(entity_extraction_prompt_template)
-      target_column_input_prompt = copy.deepcopy(entity_extraction_prompt_template)
-
-      dataset_input_prompt[1]["content"] = f"Given the context: {user_input}. If the context contains a url for a csv or parquet file, return the full url as response, otherwise only ouput one word False"
-      machine_learning_task_input_prompt[1]["content"] = f"Given the context: {user_input}. Identify if the context mentions a machine learning task on the target column in the dataset if yes then return the machine learning task as response, like regression or classification or clustering; otherwise only ouput one word False"
-      target_column_input_prompt[1]["content"] = f"Given the context: {user_input}. Identify if the context mentions a target column to be used for the machine leraning problem, if yes then return the target column  as response, otherwise only ouput one word False"
+      if hasattr(self.lm, 'generate_structured'):
+        extracted = self.extract_entities_structured(user_input, entity_extraction_prompt_template)
+      else:
+        extracted = self.extract_entities_batched(user_input, entity_extraction_prompt_template)
+      # Entities found in an earlier message are kept when this one does not mention them
+      extracted = {key: value for key, value in extracted.items() if value and value != 'False'}
 
-      if not self.dataset_url:
-        self.dataset_url = self.lm.generate_text(dataset_input_prompt, self.generation_args)
+      if 'dataset_url' in extracted:
+        self.dataset_url = extracted['dataset_url']
         # Check if the URL is valid
         if not DatasetLocationModel.validate_location(self.dataset_url):
           self.dataset_url = None
 
-      if not self.machine_learning_task:
-        self.machine_learning_task = self.lm.generate_text(machine_learning_task_input_prompt, self.generation_args)
+      if 'machine_learning_task' in extracted:
+        self.machine_learning_task = extracted['machine_learning_task']
         # Check if the machine_learning_task is valid
         if not self.machine_learning_task or self.machine_learning_task.lower() not in self.supported_ml_tasks:
           self.machine_learning_task = None
 
-      if not self.target_column:
-        self.target_column = self.lm.generate_text(target_column_input_prompt, self.generation_args)
+      if 'target_column' in extracted:
+        self.target_column = extracted['target_column']
       # Check if the target_column is valid
       if self.dataset_url:
-        data = None
-        if self.dataset_url.endswith(".csv"):
-          data = pd.read_csv(self.dataset_url, nrows= 10)
-        else:
-          data = pd.read_parquet(self.dataset_url).head(10)
-
-        if not self.target_column in data.columns:
+        if not self.target_column in self.dataset_columns(self.dataset_url):
           self.target_column = None
 
       return None
 
+    def extract_entities_structured(self, user_input, entity_extraction_prompt_template):
+      # One constrained generation returns every entity as JSON: the task can only be one of the
+      # supported ones and the target one of the dataset columns, once the dataset URL is known
+      prompt = copy.deepcopy(entity_extraction_prompt_template)
+      if self.dataset_url and self.dataset_url not in self.known_columns:
+        # Looked up before decoding, the options are requested from inside the logits processor
+        self.known_columns[self.dataset_url] = self.column_options(self.dataset_url)
+      prompt[1]["content"] = (
+        f"Given the context: {user_input}. Extract the full url of the csv or parquet dataset, the machine learning task "
+        f"({', '.join(self.supported_ml_tasks)}) and the target column for the machine learning problem. "
+        "Respond with a JSON object with the keys dataset_url, machine_learning_task and target_column, "
+        "use null for anything the context does not mention."
+      )
+      fields = [
+        ('dataset_url', None),
+        ('machine_learning_task', self.supported_ml_tasks),
+        ('target_column', self.target_column_options),
+      ]
+      return self.lm.generate_structured(prompt, fields, self.structured_generation_args)
+
+    def target_column_options(self, values):
+      # Called while decoding with the values generated so far, None leaves the column unconstrained
+      dataset_url = values[0] if values[0] and DatasetLocationModel.validate_location(values[0]) else self.dataset_url
+      if not dataset_url:
+        return None
+      if dataset_url not in self.known_columns:
+        if DatasetCache.is_remote(dataset_url):
+          # A remote location first seen while decoding would stall every batch on the download
+          return None
+        self.known_columns[dataset_url] = self.column_options(dataset_url)
+      return self.known_columns[dataset_url]
+
+    def column_options(self, dataset_url):
+      try:
+        return [str(column) for column in self.dataset_columns(dataset_url)]
+      except Exception:
+        return None
+
+    def dataset_columns(self, dataset_url):
+      if self.dataset_cache is not None:
+        # Schema only, the cached copy is reused by every later execution
+        return self.dataset_cache.columns(dataset_url)
+      # pandas is only imported when it is needed, it is slow to import
+      import pandas as pd
+      if dataset_url.endswith(".csv"):
+        return pd.read_csv(dataset_url, nrows= 0).columns
+      elif not DatasetCache.is_remote(dataset_url):
+        import pyarrow.parquet as pq
+        return pq.read_schema(dataset_url).names
+      else:
+        return pd.read_parquet(dataset_url).columns
+
+    def extract_entities_batched(self, user_input, entity_extraction_prompt_template):
+      # Generate prompt for entity extraction
+      dataset_input_prompt = copy.deepcopy(entity_extraction_prompt_template)
+      machine_learning_task_input_prompt = copy.deepcopy(entity_extraction_prompt_template)
+      target_column_input_prompt = copy.deepcopy(entity_extraction_prompt_template)
+
+      dataset_input_prompt[1]["content"] = f"Given the context: {user_input}. If the context contains a url for a csv or parquet file, return the full url as response, otherwise only ouput one word False"
+      machine_learning_task_input_prompt[1]["content"] = f"Given the context: {user_input}. Identify if the context mentions a machine learning task on the target column in the dataset if yes then return the machine learning task as response, like regression or classification or clustering; otherwise only ouput one word False"
+      target_column_input_prompt[1]["content"] = f"Given the context: {user_input}. Identify if the context mentions a target column to be used for the machine leraning problem, if yes then return the target column  as response, otherwise only ouput one word False"
+
+      # Only ask for the entities that are still missing, all in one batched call
+      pending_prompts = {}
+      if not self.dataset_url:
+        pending_prompts['dataset_url'] = dataset_input_prompt
+      if not self.machine_learning_task:
+        pending_prompts['machine_learning_task'] = machine_learning_task_input_prompt
+      if not self.target_column:
+        pending_prompts['target_column'] = target_column_input_prompt
+
+      responses = self.lm.generate_batch(list(pending_prompts.values()), self.generation_args)
+      return dict(zip(pending_prompts.keys(), responses))
+
     def is_chat_successful(self):
       return self.dataset_url and self.machine_learning_task and self.target_column
 
@@ -58,7 +128,7 @@ class Conversation:
     def chat(self, entity_extraction_prompt_template):
       retries = 0
       while retries < self.max_retries and not (self.dataset_url and self.machine_learning_task and self.target_column):
-        user_input = input("")
+        user_input = self.input_fn("")
         self.extract_entities(user_input, entity_extraction_prompt_template)
         if self.dataset_url:
           print("Dataset URL:", self.dataset_url)
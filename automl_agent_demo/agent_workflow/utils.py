@@ -12,23 +12,37 @@ class DataExtractor:
             print(f"Error fetching the URL: {e}")
             return None
         
+    # Tags holding a block of documentation text, nested ones are covered by their outermost block
+    BLOCK_TAGS = ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'pre', 'code', 'li', 'dt', 'dd']
+
     @staticmethod
-    def extract_data(content: str) -> str:
+    def extract_blocks(content: str) -> list:
+        """Return the (element_type, text) blocks of the page in order, each text appearing once."""
         soup = BeautifulSoup(content, 'lxml')
-        # Initialize a list to keep all elements in order
-        elements = []
-
-        # Extract all relevant tags
-        for tag in soup.find_all(['p', 'code', 'div'], recursive=True):
-            if tag.name == 'p':
-                elements.append(('paragraph', tag.get_text()))
-            if tag.name == 'code':
-                elements.append(('code', tag.get_text()))
-            elif tag.name == 'div' and 'section' in tag.get('class', []):
-                elements.append(('section', tag.get_text()))
+        blocks = []
+        seen = set()
+        for tag in soup.find_all(DataExtractor.BLOCK_TAGS):
+            # A code tag inside a paragraph or a paragraph inside a list item is already in its parent's text
+            if tag.find_parent(DataExtractor.BLOCK_TAGS) is not None:
+                continue
+            text = tag.get_text().strip()
+            if not text or text in seen:
+                continue
+            seen.add(text)
+            if tag.name.startswith('h'):
+                element_type = 'heading'
+            elif tag.name in ('pre', 'code'):
+                element_type = 'code'
+            else:
+                element_type = 'paragraph'
+            blocks.append((element_type, text))
+        return blocks
 
-        extracted_content = ""
-        for i, (element_type, text) in enumerate(elements):
-            extracted_content = extracted_content + "\n" + f"{element_type.capitalize()} {i + 1}: {text}"
-
-        return extracted_content
+    @staticmethod
+    def extract_data(content: str) -> str:
+        elements = DataExtractor.extract_blocks(content)
+        extracted_content = [
+            f"{element_type.capitalize()} {i + 1}: {text}"
+            for i, (element_type, text) in enumerate(elements)
+        ]
+        return "\n" + "\n".join(extracted_content)
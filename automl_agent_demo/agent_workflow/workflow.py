@@ -1,18 +1,29 @@
-from transitions import Machine
-import graphviz
-from .node_config import NodeState
+import uuid
+from .node_config import NodeConfig, NodeState
+from .instrumentation import Tracer
 from .nodes import *
 
 # Shared context for passing data between nodes
 class WorkflowContext:
-    def __init__(self, lm, documentation):
+    def __init__(self, lm, documentation, executor=None, dataset_cache=None, input_fn=input, fix_memo=None, tracer=None):
         self.inputs = None
         self.code = None
+        self.candidates = []  # Alternative generated codes raced against each other
         self.fixed_code = None
         self.execution_success = None
         self.errors = None
+        self.pending_fix = None  # (error signature, replacements, failing statement) of the last fix, until it is confirmed
         self.lm = lm
         self.library_doc = documentation
+        self.executor = executor  # Optional ExecutionPool running generated code out of process
+        self.dataset_cache = dataset_cache  # Optional DatasetCache shared by validation and execution
+        self.input_fn = input_fn  # Where user messages come from, input() for the interactive CLI
+        self.fix_memo = fix_memo  # Optional FixMemo of fixes that worked in earlier sessions
+        self.session_id = uuid.uuid4().hex
+        # Prompts and generation arguments, built once so tokenized prompt parts are reused across nodes.
+        # The tokenizer is fetched at the first prompt, the model may still be loading in the background
+        self.config = NodeConfig(load_tokenizer=lambda: getattr(lm, 'tokenizer', None))
+        self.tracer = tracer or Tracer()  # Spans of node runs and code executions, in memory by default
 
 
 # The workflow graph using the transitions library
@@ -20,43 +31,79 @@ class Workflow:
     states = [
         'collecting_inputs',
         'generating_code',
+        'validating_code',
         'executing_code',
         'fixing_errors',
         'finished',
         'max_retries_reached'
     ]
 
-    def __init__(self, lm, documentation):
-        self.context = WorkflowContext(lm, documentation)
+    def __init__(self, lm, documentation, executor=None, dataset_cache=None, input_fn=input, num_candidates=1, fix_memo=None, patch_fixes=False, tracer=None, checkpoint=None):
+        self.context = WorkflowContext(lm, documentation, executor, dataset_cache, input_fn, fix_memo, tracer)
+        self.checkpoint = checkpoint  # Optional WorkflowCheckpoint saved after every transition
         self.nodes = {
             'collecting_inputs': CollectInputsNode('collect_inputs', self.context),
-            'generating_code': GenerateCodeNode('generate_code', self.context),
+            'generating_code': GenerateCodeNode('generate_code', self.context, num_candidates=num_candidates),
+            'validating_code': ValidateCodeNode('validate_code', self.context),
             'executing_code': ExecuteCodeNode('execute_code', self.context),
-            'fixing_errors': FixErrorsNode('fix_errors', self.context),
+            'fixing_errors': FixErrorsNode('fix_errors', self.context, patch_mode=patch_fixes),
         }
         self.current_node = self.nodes['collecting_inputs']
         self.state = NodeState.COLLECTING_INPUTS
         self.transitions = []  # Track global transitions
 
         # Set up the state machine
-        self.machine = Machine(model=self, states=Workflow.states, initial='collecting_inputs')
+        from transitions import Machine
+        self.machine = Machine(model=self, states=Workflow.states, initial='collecting_inputs', after_state_change='save_checkpoint')
 
         # Define transitions between states
         self.machine.add_transition('collect_inputs', 'collecting_inputs', 'generating_code', conditions='run_collecting_inputs')
-        self.machine.add_transition('generate_code', 'generating_code', 'executing_code', conditions='run_generating_code')
+        self.machine.add_transition('generate_code', 'generating_code', 'validating_code', conditions='run_generating_code')
+        self.machine.add_transition('validate_code', 'validating_code', 'executing_code', conditions='run_validating_code')
+        self.machine.add_transition('validation_failed', 'validating_code', 'fixing_errors')
         self.machine.add_transition('execute_code', 'executing_code', 'finished', conditions='run_executing_code')
         self.machine.add_transition('execution_failed', 'executing_code', 'fixing_errors')
-        self.machine.add_transition('fix_errors', 'fixing_errors', 'executing_code', conditions='run_fixing_errors')
+        self.machine.add_transition('fix_errors', 'fixing_errors', 'validating_code', conditions='run_fixing_errors')
         self.machine.add_transition('max_retries', '*', 'max_retries_reached')
 
+    def save_checkpoint(self):
+        if self.checkpoint is None:
+            return
+        # A finished run is not resumed, its checkpoint goes away
+        if self.is_done():
+            self.checkpoint.clear()
+        else:
+            self.checkpoint.save(self)
+
+    def restore(self, data):
+        """Continue from a loaded checkpoint: the node of the saved state runs next, without redoing earlier ones."""
+        for field, value in data["context"].items():
+            setattr(self.context, field, value)
+        if self.context.pending_fix is not None:
+            self.context.pending_fix = tuple(self.context.pending_fix)
+        self.context.candidates = self.context.candidates or []
+        for key, state in data["nodes"].items():
+            if key in self.nodes:
+                self.nodes[key].set_state(state)
+        self.machine.set_state(data["state"])
+        print('Resuming workflow from state:', self.state)
+
     def run_collecting_inputs(self):
-        return self.nodes['collecting_inputs'].run()
+        return self.run_node('collecting_inputs')
 
     def run_generating_code(self):
-        return self.nodes['generating_code'].run()
+        return self.run_node('generating_code')
+
+    def run_validating_code(self):
+        success = self.run_node('validating_code')
+        if success:
+            return True
+        else:
+            self.validation_failed()
+            return False
 
     def run_executing_code(self):
-        success = self.nodes['executing_code'].run()
+        success = self.run_node('executing_code')
         if success:
             return True
         else:
@@ -64,35 +111,61 @@ class Workflow:
             return False
 
     def run_fixing_errors(self):
-        can_retry = self.nodes['fixing_errors'].run()
+        can_retry = self.run_node('fixing_errors')
         if can_retry:
             return True
         else:
             self.max_retries()
             return False
 
+    def run_node(self, state):
+        # Every node run is a span, its transition lets visualize_workflow put timings on the edges
+        node = self.nodes[state]
+        with self.context.tracer.span("node", node.name, session_id=self.context.session_id, state=state) as span:
+            result = node.run()
+            span.attributes["result"] = bool(result)
+            if node.transitions:
+                source_state, dest_state = node.transitions[-1]
+                span.attributes.update({"source": source_state.name, "dest": dest_state.name, "transition_index": len(node.transitions) - 1})
+        return result
+
+    def next_trigger(self):
+        # Trigger that runs the node of the current state
+        return {
+            'collecting_inputs': self.collect_inputs,
+            'generating_code': self.generate_code,
+            'validating_code': self.validate_code,
+            'executing_code': self.execute_code,
+            'fixing_errors': self.fix_errors,
+        }[self.state]
+
+    def is_done(self):
+        return self.state in ['finished', 'max_retries_reached']
+
     def run(self):
-        while self.state not in ['finished', 'max_retries_reached']:
+        while not self.is_done():
             print('Inside Workflow, current state is:', self.state)
-            if self.state == 'collecting_inputs':
-                self.collect_inputs()
-            elif self.state == 'generating_code':
-                self.generate_code()
-            elif self.state == 'executing_code':
-                self.execute_code()
-            elif self.state == 'fixing_errors':
-                self.fix_errors()
+            self.next_trigger()()
 
             # Collect global transitions for the workflow graph
             self.transitions.append((self.state, self.current_node.name, self.state))
 
-    def visualize_workflow(self, filename='workflow_graph'):
+    def visualize_workflow(self, filename='workflow_graph', annotate_timings=False):
+        import graphviz
         dot = graphviz.Digraph(comment='Workflow Execution')
+        timings = {}
+        if annotate_timings:
+            for span in self.context.tracer.find("node", session_id=self.context.session_id):
+                if "transition_index" in span.attributes:
+                    timings[(span.name, span.attributes["transition_index"])] = span.duration
         # Add nodes and edges to the graph
         for node_name, node in self.nodes.items():
             dot.node(node_name, node_name)
-            for (source_state, dest_state) in node.transitions:
-                dot.edge(source_state.name, dest_state.name, label=f'{node_name}')
+            for index, (source_state, dest_state) in enumerate(node.transitions):
+                label = f'{node_name}'
+                if (node.name, index) in timings:
+                    label += f' ({timings[(node.name, index)]:.1f}s)'
+                dot.edge(source_state.name, dest_state.name, label=label)
 
         # Render the graph to a file
         dot.render(filename, format='png', cleanup=True)
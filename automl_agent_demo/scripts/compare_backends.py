@@ -0,0 +1,64 @@
+import argparse
+import json
+from agent_workflow.benchmark import compare_backends, format_backend_report
+from agent_workflow.node_config import NodeConfig
+
+# name -> LanguageModel arguments, the first one is the reference for the quality columns
+BACKENDS = {
+    "auto": {"backend": "auto"},
+    "cpu": {"backend": "cpu"},
+    "cpu-int8": {"backend": "cpu", "quantization": "int8"},
+    "cpu-int4": {"backend": "cpu", "quantization": "int4"},
+}
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare latency, memory and output quality of language model backends")
+    parser.add_argument("--model-name", default="microsoft/Phi-3-mini-128k-instruct")
+    parser.add_argument("--backends", nargs="+", default=["cpu", "cpu-int8"], choices=list(BACKENDS))
+    parser.add_argument("--num-threads", type=int, help="torch threads used by the cpu backends")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model forward")
+    parser.add_argument("--max-new-tokens", type=int, default=200)
+    parser.add_argument("--output", help="Write the results, outputs included, as JSON to this file")
+    return parser.parse_args()
+
+def workflow_prompts(config):
+    # Prompts shaped like the ones of a workflow run: entity extraction, code generation and fix
+    entity_prompt = [dict(message) for message in config.entity_extraction_prompt_template]
+    entity_prompt[1]["content"] = (
+        "Given the context: Train a classifier on https://example.com/data/adult.csv to predict income. "
+        "Identify if the context mentions a target column to be used for the machine leraning problem, if yes then return the target column  as response, otherwise only ouput one word False"
+    )
+    code_prompt = config.get_code_gen_prompt(
+        "setup(data, target) initializes the experiment. compare_models() trains and ranks the models. pull() returns the last score grid.",
+        "classification",
+        "https://example.com/data/adult.csv",
+        "income",
+    )
+    fix_prompt = config.get_code_fix_prompt(
+        "NameError: name 'adde_two_numbers' is not defined",
+        "def add_two_numbers(a, b):\n    return a + b\nprint(adde_two_numbers(1, 2))",
+        "def add_two_numbers(a, b):\n    return a + b\nprint(add_two_numbers(1, 2))",
+        ["Traceback (most recent call last):\n", "KeyError: 'incom'\n"],
+        "import pandas as pd\ndata = pd.read_csv('https://example.com/data/adult.csv')\nprint(data['incom'].mean())",
+    )
+    return [entity_prompt, code_prompt, fix_prompt]
+
+def main():
+    args = parse_args()
+    from agent_workflow.language_model import LanguageModel
+
+    def load_model(**options):
+        if options.get("backend") == "cpu":
+            options.update({"num_threads": args.num_threads, "compile_model": args.compile})
+        return LanguageModel(args.model_name, **options)
+
+    prompts = workflow_prompts(NodeConfig())
+    generation_args = {"do_sample": False, "max_new_tokens": args.max_new_tokens}
+    results = compare_backends(load_model, {name: dict(BACKENDS[name]) for name in args.backends}, prompts, generation_args)
+    print(format_backend_report(results))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+if __name__ == "__main__":
+    main()
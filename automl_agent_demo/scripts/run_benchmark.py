@@ -0,0 +1,73 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+from agent_workflow.benchmark import (
+    BenchmarkScenario,
+    FakeLanguageModel,
+    compare_to_baseline,
+    format_report,
+    load_baseline,
+    run_scenario,
+    save_baseline,
+)
+from agent_workflow.dataset_cache import DatasetCache
+from agent_workflow.executor import ExecutionPool
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the workflow offline with a stand-in language model")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000], help="Rows of the generated datasets")
+    parser.add_argument("--formats", nargs="+", default=["csv", "parquet"], choices=["csv", "parquet"])
+    parser.add_argument("--fail-first", action="store_true", help="Also run scenarios whose first code goes through a fix")
+    parser.add_argument("--data-dir", default=str(Path.home() / ".cache" / "automl_agent" / "benchmark"))
+    parser.add_argument("--responses", help="JSON lines of recorded {match, response} rules tried before the synthetic ones")
+    parser.add_argument("--prefill-latency", type=float, default=0.0, help="Seconds per simulated generation")
+    parser.add_argument("--latency-per-token", type=float, default=0.0, help="Seconds per simulated generated token")
+    parser.add_argument("--tokens-per-response", type=int, default=None)
+    parser.add_argument("--executor", action="store_true", help="Run code in an ExecutionPool instead of in process")
+    parser.add_argument("--dataset-cache", action="store_true", help="Read datasets through a DatasetCache")
+    parser.add_argument("--baseline", default="benchmark_baseline.json")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before reporting a regression")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    scenarios = [
+        BenchmarkScenario(f"{file_format}_{rows}{'_fix' if fail_first else ''}", rows, file_format, fail_first)
+        for rows in args.sizes
+        for file_format in args.formats
+        for fail_first in ([False, True] if args.fail_first else [False])
+    ]
+    lm_options = {
+        "prefill_latency": args.prefill_latency,
+        "latency_per_token": args.latency_per_token,
+        "tokens_per_response": args.tokens_per_response,
+    }
+    extra_rules = FakeLanguageModel.load_rules(args.responses) if args.responses else []
+    executor = ExecutionPool(size=2) if args.executor else None
+    dataset_cache = DatasetCache(str(Path(args.data_dir) / "cache")) if args.dataset_cache else None
+
+    try:
+        results = [run_scenario(scenario, args.data_dir, executor, dataset_cache, lm_options, extra_rules) for scenario in scenarios]
+    finally:
+        if executor is not None:
+            executor.close()
+
+    print(format_report(results))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.update_baseline:
+        save_baseline(args.baseline, results)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    regressions = compare_to_baseline(results, load_baseline(args.baseline), args.tolerance)
+    for regression in regressions:
+        print("Regression:", regression)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import argparse
+import os
+from pathlib import Path
+from agent_workflow.model_server import DEFAULT_SOCKET, ModelServer
+from agent_workflow.response_cache import ResponseCache
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Keep one language model loaded and serve it to workflow processes")
+    parser.add_argument("--model-name", default="microsoft/Phi-3-mini-128k-instruct")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket to listen on")
+    parser.add_argument("--port", type=int, help="Listen on 127.0.0.1:PORT instead, needs MODEL_SERVER_AUTHKEY")
+    parser.add_argument("--backend", default="auto", choices=["auto", "cpu"])
+    parser.add_argument("--quantization", choices=["int8", "int4"], help="Weight quantization of the cpu backend")
+    parser.add_argument("--num-threads", type=int, help="torch threads used by the cpu backend")
+    parser.add_argument("--compile", action="store_true", help="torch.compile the model forward")
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-wait", type=float, default=0.05, help="Seconds a request waits for others to join its batch")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    authkey = os.environ.get("MODEL_SERVER_AUTHKEY")
+    from agent_workflow.language_model import LanguageModel
+    cache_dir = Path.home() / ".cache" / "automl_agent"
+    response_cache = ResponseCache(path=str(cache_dir / "responses.sqlite"))
+    lm = LanguageModel(
+        args.model_name,
+        response_cache=response_cache,
+        backend=args.backend,
+        quantization=args.quantization,
+        num_threads=args.num_threads,
+        compile_model=args.compile,
+    )
+    server = ModelServer(
+        lm,
+        address=args.socket,
+        port=args.port,
+        authkey=authkey.encode() if authkey else None,
+        max_batch_size=args.max_batch_size,
+        max_wait=args.max_wait,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+if __name__ == "__main__":
+    main()
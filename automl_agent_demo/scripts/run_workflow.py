@@ -1,20 +1,111 @@
-from agent_workflow.language_model import LanguageModel
+import argparse
+from pathlib import Path
+from agent_workflow.response_cache import ResponseCache
+from agent_workflow.executor import ExecutionPool
+from agent_workflow.dataset_cache import DatasetCache
+from agent_workflow.code_patch import FixMemo
 from agent_workflow.workflow import Workflow
 from agent_workflow.utils import DataExtractor
+from agent_workflow.doc_index import DocumentationIndex
+from agent_workflow.instrumentation import Tracer
+from agent_workflow.model_loader import BackgroundModel
+from agent_workflow.model_server import ModelClient
+from agent_workflow.checkpoint import WorkflowCheckpoint
+
+def load_language_model(model_name, response_cache, tracer, **backend_options):
+    # torch and transformers are imported here, in the loader thread, not at startup
+    from agent_workflow.language_model import LanguageModel
+    return LanguageModel(model_name, response_cache=response_cache, tracer=tracer, **backend_options)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate, run and fix AutoML code for a dataset")
+    parser.add_argument(
+        "--resume", nargs="?", const="latest", metavar="SESSION_ID",
+        help="Continue an interrupted run, the most recent one unless a session id is given",
+    )
+    parser.add_argument("--checkpoint-dir", default=str(Path.home() / ".cache" / "automl_agent" / "checkpoints"))
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    return parser.parse_args()
 
 def main():
+    args = parse_args()
+    # Every run checkpoints to a file named after its session, so concurrent runs do not collide
+    checkpoint, saved = None, None
+    if args.resume == "latest":
+        checkpoint = WorkflowCheckpoint.latest(args.checkpoint_dir)
+    elif args.resume is not None:
+        checkpoint = WorkflowCheckpoint.for_session(args.checkpoint_dir, args.resume)
+        if not checkpoint.acquire():
+            raise SystemExit(f"Session {args.resume} is still running in another process")
+    if checkpoint is not None:
+        saved = checkpoint.load()
+    if args.resume is not None and saved is None:
+        print("No checkpoint to resume from, starting a new run")
+        if checkpoint is not None:
+            checkpoint.release()
+        checkpoint = None
+
+    # Start the warm execution workers first, they import pycaret while the user is typing
+    executor = ExecutionPool(size=2, timeout=1800, memory_limit_mb=8192)
 
-    documentation_url = input("Enter URL of an AutoML library's documentation: ")
+    model_name = "microsoft/Phi-3-mini-128k-instruct"
+    # On hosts without a GPU, e.g. {"backend": "cpu", "quantization": "int8", "num_threads": 8}
+    backend_options = {}
+    cache_dir = Path.home() / ".cache" / "automl_agent"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Spans are appended to spans.jsonl, aggregated metrics are only served when a port is given
+    tracer = Tracer(str(cache_dir / "spans.jsonl"))
+    if args.metrics_port is not None:
+        try:
+            tracer.serve_prometheus(args.metrics_port)
+        except OSError as error:
+            # e.g. another run already serves its metrics there, this one works without them
+            print(f"Not serving metrics on port {args.metrics_port}: {error}")
+    response_cache = ResponseCache(path=str(cache_dir / "responses.sqlite"))
+    # A model server started with run_model_server.py is shared instead of loading the model again.
+    # Otherwise the model loads in the background while the docs are fetched and the inputs are
+    # collected, the first generation waits for it only if it is not ready yet
+    lm = ModelClient.connect_or_none()
+    if lm is not None:
+        print("Using the model server, requests waiting:", lm.stats()["queue_depth"])
+    else:
+        lm = BackgroundModel(lambda: load_language_model(model_name, response_cache, tracer, **backend_options))
+
+    # A resumed run reuses the saved documentation URL and inputs, nothing is asked again
+    if saved is not None:
+        documentation_url = checkpoint.metadata.get("documentation_url", "")
+    else:
+        documentation_url = input("Enter URL of an AutoML library's documentation: ")
     raw_html = DataExtractor().fetch_url_content(documentation_url)
     documentation_context = None
     if raw_html:
-        documentation_context = DataExtractor().extract_data(raw_html)
+        documentation_context = DocumentationIndex.from_html(raw_html)
 
-    model_name = "microsoft/Phi-3-mini-128k-instruct"
-    lm = LanguageModel(model_name)
-    workflow = Workflow(lm, documentation_context)
-    workflow.run()
-    workflow.visualize_workflow(filename='workflow_graph_execution')
+    workflow = Workflow(
+        lm,
+        documentation_context,
+        executor,
+        DatasetCache(),
+        fix_memo=FixMemo(str(cache_dir / "fix_memo.json")),
+        patch_fixes=True,
+        tracer=tracer,
+        checkpoint=checkpoint,
+    )
+    if saved is not None:
+        workflow.restore(saved)
+    else:
+        workflow.checkpoint = WorkflowCheckpoint.for_session(
+            args.checkpoint_dir, workflow.context.session_id, {"documentation_url": documentation_url}
+        )
+        # Held while the run goes on, --resume skips or refuses checkpoints of running sessions
+        workflow.checkpoint.acquire()
+    print("Checkpointing to", workflow.checkpoint.path)
+    try:
+        workflow.run()
+    finally:
+        executor.close()
+        workflow.checkpoint.release()
+    workflow.visualize_workflow(filename='workflow_graph_execution', annotate_timings=True)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The scripts import agent_workflow from automl_agent_demo, the tests do the same
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
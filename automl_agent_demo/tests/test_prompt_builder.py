@@ -0,0 +1,66 @@
+import pytest
+
+tokenizers = pytest.importorskip("tokenizers")
+transformers = pytest.importorskip("transformers")
+
+from agent_workflow.prompt_builder import PromptBuilder, PromptPart
+
+# Chat template of Phi-3, special tokens followed by "\n" are where separately encoded pieces broke
+PHI3_CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "{% if message['role'] == 'system' %}{{'<|system|>\n' + message['content'] + '<|end|>\n'}}"
+    "{% elif message['role'] == 'user' %}{{'<|user|>\n' + message['content'] + '<|end|>\n'}}"
+    "{% elif message['role'] == 'assistant' %}{{'<|assistant|>\n' + message['content'] + '<|end|>\n'}}"
+    "{% endif %}{% endfor %}"
+    "{% if add_generation_prompt %}{{ '<|assistant|>\n' }}{% else %}{{ eos_token }}{% endif %}"
+)
+SPECIAL_TOKENS = ["<unk>", "<s>", "</s>", "<|system|>", "<|user|>", "<|assistant|>", "<|end|>"]
+CORPUS = [
+    "Write code to find and evaluate the best model for the dataset.\n",
+    "Traceback (most recent call last):\n  File \"<string>\", line 3, in <module>\nKeyError: 'label'\n",
+    "import pandas as pd\ndata = pd.read_csv(\"data.csv\")\nprint(data.head())\n",
+    "You are a helpful assistant writing Python code with pycaret.\n",
+]
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    # SentencePiece-style BPE like Phi-3's: a "▁" is prepended to every separately encoded text
+    model = tokenizers.Tokenizer(tokenizers.models.BPE(unk_token="<unk>", byte_fallback=True))
+    model.pre_tokenizer = tokenizers.pre_tokenizers.Metaspace(replacement="▁", prepend_scheme="first")
+    model.decoder = tokenizers.decoders.Metaspace(replacement="▁", prepend_scheme="first")
+    trainer = tokenizers.trainers.BpeTrainer(vocab_size=300, special_tokens=SPECIAL_TOKENS)
+    model.train_from_iterator(CORPUS * 10, trainer)
+    fast = transformers.PreTrainedTokenizerFast(
+        tokenizer_object=model, unk_token="<unk>", bos_token="<s>", eos_token="</s>",
+        additional_special_tokens=SPECIAL_TOKENS[3:],
+    )
+    fast.chat_template = PHI3_CHAT_TEMPLATE
+    return fast
+
+
+@pytest.mark.parametrize("roles", [("user",), ("system", "user"), ("system", "user", "assistant", "user")])
+def test_token_ids_match_chat_template(tokenizer, roles):
+    builder = PromptBuilder(tokenizer)
+    messages = [
+        (role, [f"Instructions for the {role}:\n", PromptPart(CORPUS[index % len(CORPUS)])])
+        for index, role in enumerate(roles)
+    ]
+    prompt = builder.build(messages)
+    expected = tokenizer.apply_chat_template(list(prompt), add_generation_prompt=True, tokenize=True)
+    assert prompt.token_ids == expected
+    assert prompt.num_tokens == len(expected)
+
+
+def test_truncated_prompt_matches_chat_template_and_budget(tokenizer):
+    builder = PromptBuilder(tokenizer)
+    documentation = "\n".join(f"Section {index}: data = pd.read_csv(\"data.csv\")" for index in range(200))
+    messages = [
+        ("system", ["You are a helpful assistant writing Python code with pycaret.\n"]),
+        ("user", ["Write code to find and evaluate the best model for the dataset.\n", PromptPart(documentation, truncation="head")]),
+    ]
+    prompt = builder.build(messages, token_budget=300)
+    expected = tokenizer.apply_chat_template(list(prompt), add_generation_prompt=True, tokenize=True)
+    assert prompt.token_ids == expected
+    assert prompt.num_tokens <= 300
+    assert prompt[1]["content"].endswith("... (truncated)")